@@ -0,0 +1,208 @@
+import cv2
+import argparse
+import itertools
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+
+import tracing
+from cache import RecognitionCache
+from pipeline import preprocessPage, pageSettings
+from preprocessing import DENOISE_MODES
+from segmentation import TextSegmentation
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+
+
+def listPages(inputs):
+    "image files given directly or found in the given directories, directories are listed in name order"
+    paths = []
+    for path in inputs:
+        if os.path.isdir(path):
+            paths += [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.lower().endswith(IMAGE_EXTENSIONS)]
+        else:
+            paths.append(path)
+    return paths
+
+
+def outputNames(paths):
+    "name of the .txt file of each page: its path relative to the folder common to all pages, pages that would share a name are reported and None is returned"
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in paths]) if paths else ''
+    names = [os.path.splitext(os.path.relpath(os.path.abspath(path), root))[0] + '.txt' for path in paths]
+    pathsByName = {}
+    for (path, name) in zip(paths, names):
+        pathsByName.setdefault(name, []).append(path)
+    duplicates = [samePaths for samePaths in pathsByName.values() if len(samePaths) > 1]
+    for samePaths in duplicates:
+        print('Pages with the same output name: ' + ', '.join(samePaths), file=sys.stderr)
+    return None if duplicates else names
+
+
+def segmentPage(path, denoise, maxSkew):
+    "preprocess and segment one page, return the line index and image of each word (None if the file can't be read)"
+    img = cv2.imread(path)
+    if img is None:
+        return None
+    words = TextSegmentation(preprocessPage(img, denoise, maxSkew=maxSkew)).linesSegmentation()
+    return [(word.lineIndex, word.img) for word in words]
+
+
+def initTracing(trace):
+    "record spans and counters in a worker process if trace, they are returned with each result"
+    if trace:
+        tracing.enable(collect=True)
+
+
+def runTraced(function, *args):
+    "function(*args) in a worker process and the spans and counters recorded since the previous job, for tracing.merge"
+    return (function(*args), tracing.collect())
+
+
+recognizer = None
+
+def initRecognizer(batchSize, cacheDir, trace=False, widthBuckets=None):
+    "load the recognizer once in each recognition worker, word texts are cached in cacheDir if given"
+    global recognizer
+    initTracing(trace)
+    from classification import Recognizer
+    options = {'widthBuckets': widthBuckets} if widthBuckets else {} # the training width only by default
+    recognizer = Recognizer(batchSize=batchSize, cache=RecognitionCache(cacheDir) if cacheDir else None, **options)
+
+
+def recognizerSettings():
+    "settings of the worker's recognizer, part of the page cache keys"
+    return recognizer.settings()
+
+
+def recognizeWords(images):
+    "recognize the word images of one page with the worker's recognizer"
+    return recognizer.recognize(images)
+
+
+def pageText(lineIndices, texts):
+    "words separated by spaces, lines by new lines"
+    lines = []
+    for (lineIndex, text) in zip(lineIndices, texts):
+        if not lines or lineIndex != lines[-1][0]:
+            lines.append((lineIndex, []))
+        lines[-1][1].append(text)
+    return '\n'.join(' '.join(words) for (_, words) in lines)
+
+
+class CachedJob:
+    "stands for the pool job of a page found in the cache, with nothing traced"
+    def __init__(self, value):
+        self.value = value
+
+    def ready(self):
+        return True
+
+    def get(self):
+        return (self.value, ([], {}))
+
+
+def processPages(paths, segmenters, recognizers, batchSize, onPage, cacheDir=None, denoise='nlm', maxSkew=5.0, trace=False, widthBuckets=None):
+    "segment pages in a pool of processes, recognize their words in another one and call onPage(path, text, numWords) in input order, the spans and counters of the workers are merged into the trace of this process if trace"
+    cache = RecognitionCache(cacheDir) if cacheDir else None
+    pages = iter(paths)
+    segJobs = deque() # pages being segmented
+    recJobs = deque() # pages being recognized
+    with multiprocessing.Pool(segmenters, initializer=initTracing, initargs=(trace,)) as segPool, multiprocessing.Pool(recognizers, initializer=initRecognizer, initargs=(batchSize, cacheDir, trace, widthBuckets)) as recPool:
+        settings = pageSettings(recPool.apply(recognizerSettings), denoise, maxSkew) if cache is not None else None
+
+        def submit(path):
+            # pages already recognized skip segmentation and recognition
+            key = None
+            if cache is not None and os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    key = cache.pageKey(f.read(), settings)
+                text = cache.getPage(key)
+                if text is not None:
+                    segJobs.append((path, None, CachedJob(text)))
+                    return
+            segJobs.append((path, key, segPool.apply_async(runTraced, (segmentPage, path, denoise, maxSkew))))
+
+        for path in itertools.islice(pages, 2 * segmenters):
+            submit(path)
+
+        while segJobs or recJobs:
+            # hand the next segmented page to the recognizers, start segmenting another one
+            if segJobs:
+                (path, key, job) = segJobs.popleft()
+                (words, traced) = job.get()
+                tracing.merge(traced)
+                if isinstance(words, str):
+                    recJobs.append((path, None, None, job))
+                else:
+                    if words is None:
+                        print('Could not read ' + path, file=sys.stderr)
+                        words = []
+                    lineIndices = [lineIndex for (lineIndex, _) in words]
+                    recJobs.append((path, key, lineIndices, recPool.apply_async(runTraced, (recognizeWords, [img for (_, img) in words]))))
+                for path in itertools.islice(pages, 1):
+                    submit(path)
+
+            # output recognized pages in order, wait for them when too many are pending or nothing is left to segment
+            while recJobs and (recJobs[0][3].ready() or len(recJobs) > 2 * recognizers or not segJobs):
+                (path, key, lineIndices, job) = recJobs.popleft()
+                (result, traced) = job.get()
+                tracing.merge(traced)
+                if lineIndices is None:
+                    onPage(path, result, len(result.split()))
+                    continue
+                text = pageText(lineIndices, result)
+                if key is not None:
+                    cache.putPage(key, text)
+                onPage(path, text, len(lineIndices))
+
+        if cache is not None:
+            print('Page cache: %(pageHits)d hits, %(pageMisses)d misses' % cache.stats(), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("inputs", nargs="+", help="page images or folders of page images")
+    ap.add_argument("-o", "--out", default=None, help="folder where a .txt file is written for each page, at its path relative to the folder common to all pages, the text is printed if not given")
+    ap.add_argument("-s", "--segmenters", type=int, default=os.cpu_count() or 1, help="number of preprocessing and segmentation processes")
+    ap.add_argument("-r", "--recognizers", type=int, default=1, help="number of recognition processes")
+    ap.add_argument("-b", "--batch-size", type=int, default=50, help="number of words per recognition batch")
+    ap.add_argument("-c", "--cache", default=None, help="folder of the page and word recognition cache")
+    ap.add_argument("-d", "--denoise", default="nlm", choices=DENOISE_MODES, help="denoising mode")
+    ap.add_argument("-k", "--max-skew", type=float, default=5.0, help="largest page skew corrected, in degrees, 0 to disable")
+    ap.add_argument("--width-buckets", nargs="+", type=int, default=None, help="input widths of the recognizers, the training width only if not given")
+    ap.add_argument("--trace", default=None, help="file the timing of each stage in all processes is written to, as JSON lines if it ends with .jsonl or else as a Chrome trace")
+    args = vars(ap.parse_args())
+    if args["trace"]:
+        tracing.enable(args["trace"])
+
+    paths = listPages(args["inputs"])
+    if args["out"]:
+        names = outputNames(paths)
+        if names is None:
+            sys.exit(1)
+        outNames = dict(zip(paths, names))
+        os.makedirs(args["out"], exist_ok=True)
+
+    counts = {'pages': 0, 'words': 0}
+    def onPage(path, text, numWords):
+        counts['pages'] += 1
+        counts['words'] += numWords
+        if args["out"]:
+            fn = os.path.join(args["out"], outNames[path])
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+            with open(fn, 'w') as f:
+                f.write(text)
+        else:
+            print('==> ' + path)
+            print(text)
+
+    start = time.time()
+    processPages(paths, max(args["segmenters"], 1), max(args["recognizers"], 1), args["batch_size"], onPage, args["cache"], args["denoise"], args["max_skew"], args["trace"] is not None, args["width_buckets"])
+    elapsed = time.time() - start
+    print('%d pages, %d words in %.1f s: %.2f pages/s, %.1f words/s' % (counts['pages'], counts['words'], elapsed, counts['pages'] / elapsed, counts['words'] / elapsed), file=sys.stderr)
+
+    if args["trace"]:
+        tracing.disable()
+        print(tracing.formatSummary(), file=sys.stderr)
@@ -0,0 +1,358 @@
+import cv2
+import numpy as np
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from preprocessing import Preprocessing, DENOISE_MODES
+from segmentation import TextSegmentation
+
+ASSETS = ["./assets/testPara1.png", "./assets/testPara2.png", "./assets/testPara3.png"]
+DEMOS = ["./assets/demo1.jpg", "./assets/demo2.jpeg"]
+
+
+def timeit(function, *args, repeat=5):
+    "best wall time of repeat calls to function(*args)"
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+###Histograms###
+def loopHorizontalHistogram(img):
+    "pixel by pixel horizontal histogram, as it was computed before vectorization"
+    heightMax, widthMax = img.shape[:2]
+    histogram = []
+    for height in range(heightMax):
+        counter = 0
+        for width in range(widthMax):
+            if (img[height, width] == 0):
+                counter += 1
+        histogram.append(counter)
+    return(histogram)
+
+
+def loopVerticalHistogram(img):
+    "pixel by pixel vertical histogram, as it was computed before vectorization"
+    heightMax, widthMax = img.shape[:2]
+    histogram = []
+    for width in range(widthMax):
+        counter = 0
+        for height in range(heightMax):
+            if (img[height, width] == 0):
+                counter += 1
+        histogram.append(counter)
+    return(histogram)
+
+
+def benchHistograms(paths, repeat):
+    "compare loop and vectorized projection profiles on the binarized pages"
+    print('Projection profiles (best of %d)' % repeat)
+    for path in paths:
+        img = Preprocessing().resize(cv2.imread(path))
+        binary, _ = Preprocessing().binarize(img)
+        s = TextSegmentation(img)
+
+        for (name, loop, vectorized) in [('horizontal', loopHorizontalHistogram, s.horizontalHistogram),
+                                         ('vertical', loopVerticalHistogram, s.verticalHistogram)]:
+            assert list(vectorized(binary)) == loop(binary), 'histograms differ on ' + path
+            tLoop = timeit(loop, binary, repeat=repeat)
+            tVectorized = timeit(vectorized, binary, repeat=repeat)
+            print('%s %s %dx%d: loop %.2f ms, vectorized %.3f ms, speedup x%.0f' % (path, name, binary.shape[1], binary.shape[0], tLoop * 1000, tVectorized * 1000, tLoop / tVectorized))
+###Histograms###
+
+
+###Inference###
+def segmentWords(paths):
+    "word images of the resized pages, in reading order"
+    words = []
+    for path in paths:
+        img = Preprocessing().resize(cv2.imread(path))
+        words += [word.img for word in TextSegmentation(img).linesSegmentation()]
+    return words
+
+
+def benchInferenceModes(paths, repeat):
+    "latency of the recognizer for each inference mode on the words of the pages"
+    from classification import Recognizer, InferenceMode
+
+    words = segmentWords(paths)
+    print('Inference modes on %d words (best of %d)' % (len(words), repeat))
+    with Recognizer() as recognizer:
+        recognizer.recognize(words) # warm up
+        for (name, mode) in [('text', InferenceMode.Text), ('confidence', InferenceMode.Confidence), ('logits', InferenceMode.Logits)]:
+            t = timeit(recognizer.recognize, words, None, mode, repeat=repeat)
+            print('%s: %.1f ms, %.2f ms/word' % (name, t * 1000, t * 1000 / max(len(words), 1)))
+
+def coldStart(variant):
+    "build a model the given way, recognize one blank word, print load time and peak resident memory as JSON"
+    import tensorflow as tf
+    from classification import Model, Batch, FilePaths, preprocess
+
+    start = time.perf_counter()
+    charList = open(FilePaths.fnCharList).read()
+    with tf.Graph().as_default():
+        if variant == 'full':
+            model = Model(charList, mustRestore=True)
+        elif variant == 'inference':
+            model = Model(charList, mustRestore=True, inferenceOnly=True)
+        else:
+            model = Model(charList, frozenGraph=FilePaths.fnFrozenGraph)
+        loaded = time.perf_counter()
+        model.inferBatch(Batch(None, [preprocess(np.full((32, 128), 255, np.uint8), Model.imgSize)]))
+    firstWord = time.perf_counter()
+    print(json.dumps({'variant': variant, 'load': loaded - start, 'firstWord': firstWord - start,
+                      'maxRssMB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0}))
+
+
+def benchColdStart(paths, repeat):
+    "cold start time and peak memory of the full, inference-only and frozen models, each in a fresh process"
+    from classification import FilePaths
+
+    print('Cold start (fresh process per variant)')
+    for variant in ['full', 'inference', 'frozen']:
+        if variant == 'frozen' and not os.path.exists(FilePaths.fnFrozenGraph):
+            print('frozen: skipped, export it first with: python classification.py --freeze')
+            continue
+        output = subprocess.run([sys.executable, __file__, '--cold-start', variant], stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+        res = json.loads(output.strip().splitlines()[-1])
+        print('%s: load %.2f s, first word %.2f s, peak RSS %.0f MB' % (variant, res['load'], res['firstWord'], res['maxRssMB']))
+
+
+def benchDecoders(paths, repeat, beamWidths=(10, 25, 50)):
+    "decoding throughput of best path and of word beam search with several beam widths, on the RNN output of the words of the pages"
+    from classification import Recognizer, InferenceMode, FilePaths
+    from wordbeamsearch import WordBeamSearch
+
+    words = segmentWords(paths)
+    with Recognizer() as recognizer:
+        (texts, logits) = recognizer.recognize(words, mode=InferenceMode.Logits)
+        model = recognizer.model
+        mats = [model.softmax(l[:, None, :]) for l in logits]
+        decoder = WordBeamSearch.load(FilePaths.fnCorpusIndex, FilePaths.fnCorpus, FilePaths.fnCharList, FilePaths.fnWordCharList)
+
+        print('Decoders on %d words (best of %d)' % (len(words), repeat))
+        t = timeit(lambda: [model.bestPathDecode(l[:, None, :], [len(l)]) for l in logits], repeat=repeat)
+        print('best path: %.0f words/s' % (len(words) / t))
+        for beamWidth in beamWidths:
+            decoder.beamWidth = beamWidth
+            t = timeit(lambda: [decoder.decode(mat) for mat in mats], repeat=repeat)
+            changed = sum(decoder.decode(mat)[0] != text for (mat, text) in zip(mats, texts))
+            print('word beam search, beam width %d: %.0f words/s, %d words differ from best path' % (beamWidth, len(words) / t, changed))
+###Inference###
+
+
+###Deskew###
+def minAreaRectRotate(img):
+    "full resolution Otsu and minAreaRect over every ink pixel then cubic warp, as rotate() was before the projection search"
+    gray = cv2.bitwise_not(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY))
+    thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1]
+    coords = np.column_stack(np.where(thresh > 0))
+    angle = cv2.minAreaRect(coords)[-1]
+    angle = -(90 + angle) if angle < -45 else -angle
+    (height, width) = img.shape[:2]
+    m = cv2.getRotationMatrix2D((width // 2, height // 2), angle, 1.0)
+    return cv2.warpAffine(img, m, (width, height), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+
+
+def benchDeskew(paths, repeat):
+    "time of the old and new rotate and error of the estimated angle on pages rotated by known angles"
+    p = Preprocessing()
+    angles = [-4, -2, -0.5, 0, 1, 3]
+    print('Deskew (best of %d)' % repeat)
+    for path in paths:
+        img = p.resize(cv2.imread(path))
+        (height, width) = img.shape[:2]
+        errors = []
+        for angle in angles:
+            m = cv2.getRotationMatrix2D((width // 2, height // 2), angle, 1.0)
+            skewed = cv2.warpAffine(img, m, (width, height), borderMode=cv2.BORDER_REPLICATE)
+            errors.append(abs(p.estimateSkew(skewed) + angle))
+        tOld = timeit(minAreaRectRotate, img, repeat=repeat)
+        tNew = timeit(p.rotate, img, repeat=repeat)
+        print('%s %dx%d: minAreaRect %.1f ms, projection %.1f ms, max angle error %.2f deg' % (path, width, height, tOld * 1000, tNew * 1000, max(errors)))
+###Deskew###
+
+
+###Denoising###
+def readTruth(path):
+    "ground truth text of a page, stored next to it as <name>.txt, None if there is none"
+    fnTruth = os.path.splitext(path)[0] + '.txt'
+    if not os.path.exists(fnTruth):
+        return None
+    return ' '.join(open(fnTruth).read().split())
+
+
+def characterErrorRate(recognized, truth):
+    import editdistance
+    return editdistance.eval(recognized, truth) / max(len(truth), 1)
+
+
+def benchDenoise(paths, repeat):
+    "time of each denoising tier and character error rate of the recognized text, against <page>.txt or else against the nlm tier"
+    from classification import Recognizer
+
+    p = Preprocessing()
+    pages = [p.resize(cv2.imread(path)) for path in paths]
+    for (path, img) in zip(paths, pages):
+        print('%s: estimated noise %.2f' % (path, p.estimateNoise(img)))
+
+    print('Denoising tiers (best of %d)' % repeat)
+    references = [readTruth(path) for path in paths]
+    with Recognizer() as recognizer:
+        for mode in DENOISE_MODES:
+            elapsed = 0
+            errors = []
+            for (i, img) in enumerate(pages):
+                elapsed += timeit(p.denoise, img, mode, repeat=repeat)
+                words = TextSegmentation(p.denoise(img, mode)).linesSegmentation()
+                text = ' '.join(recognizer.recognize([word.img for word in words]))
+                if references[i] is None:
+                    references[i] = text # first tier (nlm) is the reference of pages without ground truth
+                errors.append(characterErrorRate(text, references[i]))
+            print('%s: %.1f ms/page, CER %.2f%%' % (mode, elapsed * 1000 / len(pages), 100 * np.mean(errors)))
+###Denoising###
+
+
+###Stages###
+def segmentTimed(img):
+    "words of the page, time spent in the whole segmentation and in the word segmentation of its lines"
+    s = TextSegmentation(img)
+    wordSegmentation = s.wordSegmentation
+    spent = [0.0]
+    def timedWordSegmentation(*args):
+        start = time.perf_counter()
+        words = wordSegmentation(*args)
+        spent[0] += time.perf_counter() - start
+        return words
+    s.wordSegmentation = timedWordSegmentation
+    start = time.perf_counter()
+    words = s.linesSegmentation()
+    return (words, time.perf_counter() - start, spent[0])
+
+
+def benchStages(paths, repeat, scales=(0.5, 1.5)):
+    "time per page or word of each stage of the pipeline"
+    # pages are the given ones and synthetic ones: the first page resized and scaled, they skip the resize stage to keep their size
+    # the images, repeat and scales are returned with the stages, a baseline is only compared with a run of the same ones
+    p = Preprocessing()
+    pages = [(path, cv2.imread(path), False) for path in paths]
+    first = p.resize(pages[0][1])
+    pages += [('%s x%g' % (paths[0], scale), cv2.resize(first, None, fx=scale, fy=scale, interpolation=cv2.INTER_CUBIC), True) for scale in scales]
+    try:
+        from classification import Recognizer
+        recognizer = Recognizer()
+    except Exception as e: # no TensorFlow, or a missing or unreadable snapshot
+        print('recognition: skipped (%s)' % e)
+        recognizer = None
+
+    stages = {}
+    def record(stage, seconds, items):
+        entry = stages.setdefault(stage, {'seconds': 0.0, 'items': 0})
+        entry['seconds'] += seconds
+        entry['items'] += items
+
+    print('Stages (best of %d)' % repeat)
+    for (name, img, synthetic) in pages:
+        # preprocessing stages, each on the output of the previous one
+        resized = img if synthetic else p.resize(img)
+        denoised = p.denoise(resized)
+        preprocessing = [('denoise', p.denoise, resized), ('binarize', p.binarize, denoised), ('rotate', p.rotate, denoised)]
+        if not synthetic:
+            preprocessing.insert(0, ('resize', p.resize, img))
+        for (stage, function, arg) in preprocessing:
+            record(stage, timeit(function, arg, repeat=repeat), 1)
+
+        # segmentation, the word segmentation of the lines is timed apart from the rest
+        runs = [segmentTimed(denoised) for _ in range(repeat)]
+        (words, total, wordTime) = min(runs, key=lambda run: run[1])
+        record('lineSegmentation', total - wordTime, 1)
+        record('wordSegmentation', wordTime, len(words))
+
+        if recognizer is not None:
+            images = [word.img for word in words]
+            record('recognition', timeit(recognizer.recognize, images, repeat=repeat), len(images))
+        print('%s %dx%d: %d words' % (name, resized.shape[1], resized.shape[0], len(words)))
+
+    if recognizer is not None:
+        recognizer.close()
+    for (stage, entry) in stages.items():
+        unit = 'word' if stage in ('wordSegmentation', 'recognition') else 'page'
+        entry['msPerItem'] = entry['seconds'] * 1000 / entry['items'] if entry['items'] else 0.0
+        print('%s: %.1f ms, %.2f ms/%s' % (stage, entry['seconds'] * 1000, entry['msPerItem'], unit))
+
+    # peak resident memory of the whole run, tracemalloc would miss what OpenCV and TensorFlow allocate
+    peakRssMB = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    print('peak RSS of the run: %.0f MB' % peakRssMB)
+    return {'images': [os.path.normpath(path) for path in paths], 'repeat': repeat, 'scales': list(scales), 'peakRssMB': peakRssMB, 'stages': stages}
+
+
+def compareToBaseline(results, baseline, threshold):
+    "stages slower per page or word than in baseline by more than the threshold ratio"
+    # raises ValueError if a benchmark of the baseline was run on other images, repeat or scales
+    regressions = []
+    for (bench, result) in results.items():
+        reference = baseline.get(bench)
+        if reference is None:
+            print('%s: not in the baseline' % bench)
+            continue
+        for setting in ('images', 'repeat', 'scales'):
+            if reference.get(setting) != result[setting]:
+                raise ValueError('%s was run with %s %s, the baseline with %s' % (bench, setting, result[setting], reference.get(setting)))
+        for (stage, entry) in result['stages'].items():
+            referenceEntry = reference['stages'].get(stage)
+            if referenceEntry is None or referenceEntry['msPerItem'] <= 0:
+                continue
+            ratio = entry['msPerItem'] / referenceEntry['msPerItem']
+            status = 'REGRESSION' if ratio > 1 + threshold else 'ok'
+            print('%s/%s: %.2f ms per item, baseline %.2f ms, x%.2f %s' % (bench, stage, entry['msPerItem'], referenceEntry['msPerItem'], ratio, status))
+            if ratio > 1 + threshold:
+                regressions.append('%s/%s' % (bench, stage))
+    return regressions
+###Stages###
+
+
+BENCHMARKS = {'histograms': benchHistograms, 'inference': benchInferenceModes, 'coldstart': benchColdStart, 'decoders': benchDecoders, 'denoise': benchDenoise, 'deskew': benchDeskew, 'stages': benchStages}
+DEFAULT_IMAGES = {'stages': ASSETS + DEMOS}
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-i", "--image", nargs="*", default=None, help="path to input image files, the test paragraphs (and demo pages for stages) by default")
+    ap.add_argument("-r", "--repeat", type=int, default=5, help="number of timed runs, the best one is kept")
+    ap.add_argument("-b", "--bench", nargs="*", choices=sorted(BENCHMARKS), default=["histograms"], help="benchmarks to run")
+    ap.add_argument("--save-baseline", default=None, help="JSON file the measured stages are written to")
+    ap.add_argument("--baseline", default=None, help="JSON file of stages measured before (on the same machine) to compare with, exits with an error on regressions")
+    ap.add_argument("--threshold", type=float, default=0.25, help="slowdown ratio over the baseline counted as a regression")
+    ap.add_argument("--cold-start", choices=['full', 'inference', 'frozen'], help=argparse.SUPPRESS)
+    args = vars(ap.parse_args())
+
+    if args["cold_start"]:
+        coldStart(args["cold_start"])
+        sys.exit(0)
+
+    results = {}
+    for name in args["bench"]:
+        result = BENCHMARKS[name](args["image"] or DEFAULT_IMAGES.get(name, ASSETS), args["repeat"])
+        if result is not None:
+            results[name] = result
+
+    if args["save_baseline"]:
+        with open(args["save_baseline"], 'w') as f:
+            json.dump(results, f, indent=2)
+    if args["baseline"]:
+        with open(args["baseline"]) as f:
+            baseline = json.load(f)
+        try:
+            regressions = compareToBaseline(results, baseline, args["threshold"])
+        except ValueError as e:
+            sys.exit('Not comparable with the baseline: %s' % e)
+        if regressions:
+            print('Regressions: ' + ', '.join(regressions))
+            sys.exit(1)
@@ -0,0 +1,212 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class LRUStore:
+    "text values evicted least recently used first, kept in memory and, if a directory is given, on disk where other processes see them"
+
+    def __init__(self, maxEntries, directory=None):
+        self.maxEntries = maxEntries
+        self.memory = OrderedDict()
+        self.directory = directory
+        self.files = OrderedDict() # keys stored on disk as far as this process knows, least recently used first
+        self.scanInterval = max(maxEntries // 10, 1) # number of puts after which the directory is listed again
+        self.putsSinceScan = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.scan()
+
+
+    def scan(self):
+        "list the files of the directory, written by any process, in their order of use"
+        names = [name for name in os.listdir(self.directory) if name.endswith('.txt')]
+        mtimes = {}
+        for name in names:
+            try:
+                mtimes[name] = os.path.getmtime(os.path.join(self.directory, name))
+            except OSError:
+                pass # removed by another process
+        self.files = OrderedDict((name[:-4], None) for name in sorted(mtimes, key=mtimes.get))
+        self.putsSinceScan = 0
+        self.evictFiles()
+
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.txt')
+
+
+    def get(self, key):
+        "stored value or None"
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        if self.directory is not None:
+            # files of other processes aren't in self.files, the file is tried anyway
+            try:
+                with open(self.path(key), encoding='utf-8') as f:
+                    value = f.read()
+                os.utime(self.path(key)) # keep the order of use across runs and processes
+            except OSError:
+                self.files.pop(key, None) # never written, or removed by another process
+                return None
+            self.files[key] = None
+            self.files.move_to_end(key)
+            self.putMemory(key, value)
+            return value
+        return None
+
+
+    def put(self, key, value):
+        self.putMemory(key, value)
+        if self.directory is not None:
+            # write then rename, so that other processes never read a partial file
+            tmpPath = self.path(key) + '.%d.tmp' % os.getpid()
+            with open(tmpPath, 'w', encoding='utf-8') as f:
+                f.write(value)
+            os.replace(tmpPath, self.path(key))
+            self.files[key] = None
+            self.files.move_to_end(key)
+            self.putsSinceScan += 1
+            if self.putsSinceScan >= self.scanInterval:
+                self.scan() # evict the files of the other processes too
+            else:
+                self.evictFiles()
+
+
+    def putMemory(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.maxEntries:
+            self.memory.popitem(last=False)
+
+
+    def evictFiles(self):
+        while len(self.files) > self.maxEntries:
+            (key, _) = self.files.popitem(last=False)
+            self.remove(key)
+
+
+    def remove(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+
+    def clear(self, keepPrefix=None):
+        "forget all values, on disk too except for keys starting with keepPrefix"
+        self.memory.clear()
+        for key in list(self.files):
+            if keepPrefix is None or not key.startswith(keepPrefix):
+                del self.files[key]
+                self.remove(key)
+
+
+class RecognitionCache:
+    "content-addressed cache of recognized texts for whole pages and for word crops, invalidated when the model checkpoint changes"
+
+    def __init__(self, directory=None, maxPages=1000, maxWords=100000, modelDir='./Classification/model/'):
+        "memory only if directory is None, otherwise also stored in directory/pages and directory/words"
+        self.lock = threading.Lock()
+        self.pages = LRUStore(maxPages, os.path.join(directory, 'pages') if directory else None)
+        self.words = LRUStore(maxWords, os.path.join(directory, 'words') if directory else None)
+        self.hits = {'pages': 0, 'words': 0}
+        self.misses = {'pages': 0, 'words': 0}
+        self.modelDir = modelDir
+        self.checkpointStamp = None
+        self.version = None
+        self.checkVersion()
+
+
+    def modelVersion(self):
+        "hash of the checkpoint file and of the index of the snapshot it names"
+        digest = hashlib.sha1()
+        fnCheckpoint = os.path.join(self.modelDir, 'checkpoint')
+        if os.path.exists(fnCheckpoint):
+            content = open(fnCheckpoint, 'rb').read()
+            digest.update(content)
+            for line in content.decode('utf-8', 'replace').splitlines():
+                if line.startswith('model_checkpoint_path:'):
+                    fnIndex = os.path.join(self.modelDir, line.split('"')[1] + '.index')
+                    if os.path.exists(fnIndex):
+                        digest.update(open(fnIndex, 'rb').read())
+        return digest.hexdigest()[:12]
+
+
+    def checkVersion(self):
+        "drop the entries of the previous model if the checkpoint changed since the last check"
+        fnCheckpoint = os.path.join(self.modelDir, 'checkpoint')
+        stamp = os.stat(fnCheckpoint).st_mtime if os.path.exists(fnCheckpoint) else None
+        if stamp == self.checkpointStamp and self.version is not None:
+            return
+        version = self.modelVersion()
+        with self.lock:
+            self.checkpointStamp = stamp
+            if version != self.version:
+                self.version = version
+                self.pages.clear(keepPrefix=version)
+                self.words.clear(keepPrefix=version)
+
+
+    def key(self, data, settings):
+        "key of an image (array) or of encoded file content (bytes) for the current model and settings"
+        digest = hashlib.sha1(settings.encode('utf-8'))
+        if isinstance(data, np.ndarray):
+            digest.update(str((data.shape, data.dtype.str)).encode('utf-8'))
+            data = np.ascontiguousarray(data)
+        digest.update(data)
+        return self.version + '-' + digest.hexdigest()
+
+
+    def pageKey(self, data, settings):
+        "key of a page image or file content, settings describe the preprocessing, segmentation and recognition"
+        self.checkVersion()
+        return self.key(data, settings)
+
+
+    def wordKeys(self, inputs, settings):
+        "keys of word images as fed to the model (preprocessed), settings describe the recognizer"
+        self.checkVersion()
+        return [self.key(img, settings) for img in inputs]
+
+
+    def get(self, level, key):
+        with self.lock:
+            value = getattr(self, level).get(key)
+            if value is None:
+                self.misses[level] += 1
+            else:
+                self.hits[level] += 1
+            return value
+
+
+    def put(self, level, key, value):
+        with self.lock:
+            getattr(self, level).put(key, value)
+
+
+    def getPage(self, key):
+        return self.get('pages', key)
+
+
+    def putPage(self, key, text):
+        self.put('pages', key, text)
+
+
+    def getWord(self, key):
+        return self.get('words', key)
+
+
+    def putWord(self, key, text):
+        self.put('words', key, text)
+
+
+    def stats(self):
+        "hit and miss counters of both levels"
+        with self.lock:
+            return {'pageHits': self.hits['pages'], 'pageMisses': self.misses['pages'],
+                    'wordHits': self.hits['words'], 'wordMisses': self.misses['words']}
@@ -1,22 +1,42 @@
 import sys
 import os
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import cv2
 import editdistance
 import numpy as np
 import matplotlib.pyplot as plt
 import tensorflow as tf
 
+import tracing
+from cache import RecognitionCache
+from wordbeamsearch import WordBeamSearch
+
 ###Preprocess###
-def preprocess(img, imgSize, dataAugmentation=False):
+@tracing.traced('classification.preprocess')
+def preprocess(img, imgSize, dataAugmentation=False, rng=random):
 	"put img into target img of size imgSize, transpose for TF and normalize gray-values"
+	# rng -- source of the random stretches if dataAugmentation
+	(target, _) = fit(img, imgSize, dataAugmentation, rng)
+	return normalize(target)
+
+
+def fit(img, imgSize, dataAugmentation=False, rng=random):
+	"8 bit grayscale img scaled into the top left corner of a white target img of size imgSize, return the target and the (width, height) of the scaled img"
 
 	# there are damaged files in IAM dataset - just use black image instead
 	if img is None:
-		img = np.zeros([imgSize[1], imgSize[0]])
+		img = np.zeros([imgSize[1], imgSize[0]], np.uint8)
 
 	# increase dataset size by applying random stretches to the images
 	if dataAugmentation:
-		stretch = (random.random() - 0.5) # -0.5 .. +0.5
+		stretch = (rng.random() - 0.5) # -0.5 .. +0.5
 		wStretched = max(int(img.shape[1] * (1 + stretch)), 1) # random width, but at least 1
 		img = cv2.resize(img, (wStretched, img.shape[0])) # stretch horizontally by factor 0.5 .. 1.5
 
@@ -28,28 +48,29 @@ def preprocess(img, imgSize, dataAugmentation=False):
 	f = max(fx, fy)
 	newSize = (max(min(wt, int(w / f)), 1), max(min(ht, int(h / f)), 1)) # scale according to f (result at least 1 and at most wt or ht)
 	img = cv2.resize(img, newSize)
-	target = np.ones([ht, wt]) * 255
+	target = np.full([ht, wt], 255, np.uint8)
 	target[0:newSize[1], 0:newSize[0]] = img
+	return (target, newSize)
 
-	# transpose for TF
-	img = cv2.transpose(target)
 
-	# normalize
-	(m, s) = cv2.meanStdDev(img)
-	m = m[0][0]
-	s = s[0][0]
-	img = img - m
-	img = img / s if s>0 else img
-	return img
+def normalize(imgs):
+	"transpose fitted imgs (HxW, or a stack of them) for TF and normalize their gray-values to zero mean and unit variance"
+	imgs = np.swapaxes(imgs, -1, -2).astype(np.float32)
+	m = imgs.mean(axis=(-2, -1), keepdims=True)
+	s = imgs.std(axis=(-2, -1), keepdims=True)
+	return (imgs - m) / np.where(s > 0, s, 1)
 
 ###Preprocess###
 
 ###DataLoader###
 class Sample:
-	"sample from the dataset"
-	def __init__(self, gtText, filePath):
+	"sample from the dataset, its image is a file or is stored in a shard at offset with its fitted size"
+	def __init__(self, gtText, filePath, fnShard=None, offset=None, size=None):
 		self.gtText = gtText
 		self.filePath = filePath
+		self.fnShard = fnShard
+		self.offset = offset
+		self.size = size
 
 
 class Batch:
@@ -59,20 +80,144 @@ class Batch:
 		self.gtTexts = gtTexts
 
 
+class ImageBatch:
+	"batch of word images as read, of different sizes, and their ground truth texts"
+	def __init__(self, gtTexts, imgs):
+		self.imgs = imgs
+		self.gtTexts = gtTexts
+
+
+def loadBatch(samples, imgSize, augmentationSeed):
+	"read and preprocess a batch of (gtText, filePath) samples"
+	# augmentationSeed -- seed of the random stretches, no augmentation if None
+	rng = random.Random(augmentationSeed)
+	gtTexts = [gtText for (gtText, _) in samples]
+	imgs = [preprocess(cv2.imread(filePath, cv2.IMREAD_GRAYSCALE), imgSize, augmentationSeed is not None, rng) for (_, filePath) in samples]
+	return Batch(gtTexts, imgs)
+
+
+def loadImageBatch(samples, imgSize, augmentationSeed):
+	"read the (gtText, filePath) samples of a batch without preprocessing them"
+	return ImageBatch([gtText for (gtText, _) in samples], [cv2.imread(filePath, cv2.IMREAD_GRAYSCALE) for (_, filePath) in samples])
+
+
+openShards = {} # shard file name -> memory-mapped images, per process
+
+def openShard(fnShard):
+	"memory-mapped images of a shard, opened once per process"
+	if fnShard not in openShards:
+		openShards[fnShard] = np.load(fnShard, mmap_mode='r')
+	return openShards[fnShard]
+
+
+def loadShardBatch(samples, imgSize, augmentationSeed):
+	"batch of the (gtText, fnShard, offset, width, height) samples stored in shards, with random stretches drawn from augmentationSeed unless it is None"
+	gtTexts = [gtText for (gtText, _, _, _, _) in samples]
+	if augmentationSeed is None:
+		# the stored images are already fitted, only a copy and the normalization are left
+		imgs = np.stack([openShard(fnShard)[offset] for (_, fnShard, offset, _, _) in samples])
+	else:
+		# stretch the stored image and fit it again
+		rng = random.Random(augmentationSeed)
+		imgs = np.stack([fit(openShard(fnShard)[offset, :h, :w], imgSize, True, rng)[0] for (_, fnShard, offset, w, h) in samples])
+	return Batch(gtTexts, normalize(imgs))
+
+
+def loadShardImageBatch(samples, imgSize, augmentationSeed):
+	"stored images of shard samples, without preprocessing"
+	# shards only hold the images scaled to fit imgSize
+	return ImageBatch([gtText for (gtText, _, _, _, _) in samples], [np.array(openShard(fnShard)[offset, :h, :w]) for (_, fnShard, offset, w, h) in samples])
+
+
+def buildShards(loader, outDir, shardSize=10000, workers=4):
+	"read and fit the images of the dataset of loader once, store them in outDir as 8 bit shards of shardSize images with an index of texts, DataLoader(outDir) reads them"
+	os.makedirs(outDir, exist_ok=True)
+	(wt, ht) = loader.imgSize
+	samples = loader.datasetSamples
+	index = {'imgSize': [wt, ht], 'shards': [], 'samples': []}
+	fitSample = lambda sample: fit(cv2.imread(sample.filePath, cv2.IMREAD_GRAYSCALE), loader.imgSize)
+	with ThreadPoolExecutor(max(workers, 1)) as executor:
+		for start in range(0, len(samples), shardSize):
+			chunk = samples[start:start + shardSize]
+			name = 'images-%05d.npy' % len(index['shards'])
+			shard = np.lib.format.open_memmap(os.path.join(outDir, name), mode='w+', dtype=np.uint8, shape=(len(chunk), ht, wt))
+			for (offset, (target, (w, h))) in enumerate(executor.map(fitSample, chunk)):
+				shard[offset] = target
+				index['samples'].append([chunk[offset].gtText, len(index['shards']), offset, w, h])
+			shard.flush()
+			del shard
+			index['shards'].append(name)
+			print('Shard %s: %d images' % (name, len(chunk)))
+	with open(os.path.join(outDir, 'index.json'), 'w') as f:
+		json.dump(index, f)
+
+
 class DataLoader:
 	"loads data which corresponds to IAM format, see: http://www.fki.inf.unibe.ch/databases/iam-handwriting-database"
 
-	def __init__(self, filePath, batchSize, imgSize, maxTextLen):
-		"loader for dataset at given location, preprocess images and text according to parameters"
-
-		assert filePath[-1]=='/'
+	def __init__(self, filePath, batchSize, imgSize, maxTextLen, workers=4, prefetch=8, useProcesses=False, seed=None):
+		"loader for dataset at given location"
+		# filePath -- IAM dataset, shards written by buildShards, or labeled images (folder or manifest, see readLabeled) only used for validation
+		# workers -- threads (or processes if useProcesses) loading batches in the background, 0 to load them when asked for
+		# prefetch -- number of batches loaded ahead
+		# seed -- seed of the shuffling and of the data augmentation, batches don't depend on the number of workers
 
 		self.dataAugmentation = False
+		self.partialBatches = False # whether the last batch may have less than batchSize samples
+		self.truncateTexts = False # whether texts are truncated to what ctc_loss can learn, only for training targets
+		self.rawImages = False # whether batches hold the images as read instead of preprocessed ones
+		self.maxTextLen = maxTextLen
 		self.currIdx = 0
 		self.batchSize = batchSize
 		self.imgSize = imgSize
 		self.samples = []
+		self.rng = random.Random(seed)
+		self.prefetch = max(prefetch, 1)
+		self.pending = deque() # batches being loaded, in order
+		self.nextIdx = 0 # first sample of the next batch to load
+		self.executor = None
+		if workers > 0:
+			self.executor = (ProcessPoolExecutor if useProcesses else ThreadPoolExecutor)(workers)
+
+		# samples of the dataset in their order, images read from shards if there is an index of them
+		self.sharded = os.path.isdir(filePath) and os.path.exists(os.path.join(filePath, 'index.json'))
+		self.labeled = os.path.isfile(filePath) or not (self.sharded or os.path.exists(os.path.join(filePath, 'words.txt')))
+		if self.labeled:
+			self.samples = self.readLabeled(filePath, maxTextLen)
+			chars = set(str().join(sample.gtText for sample in self.samples))
+		else:
+			assert filePath[-1]=='/'
+			if self.sharded:
+				self.samples = self.readShards(filePath, maxTextLen)
+				chars = set(str().join(sample.gtText for sample in self.samples))
+			else:
+				(self.samples, chars) = self.readIAM(filePath, maxTextLen)
+		if not self.samples:
+			raise Exception('No samples found in: ' + filePath)
+		self.datasetSamples = self.samples
+
+		# split into training and validation set: 95% - 5%, labeled images are all for validation
+		splitIdx = 0 if self.labeled else int(0.95 * len(self.samples))
+		self.trainSamples = self.samples[:splitIdx]
+		self.validationSamples = self.samples[splitIdx:]
+
+		# put words into lists
+		self.trainWords = [x.gtText for x in self.trainSamples]
+		self.validationWords = [x.gtText for x in self.validationSamples]
+
+		# number of randomly chosen samples per epoch for training
+		self.numTrainSamplesPerEpoch = 25000
+
+		# start with train set
+		self.trainSet()
+
+		# list of all chars in dataset
+		self.charList = sorted(list(chars))
+
 
+	def readIAM(self, filePath, maxTextLen):
+		"samples of the IAM dataset and the chars of their texts"
+		samples = []
 		f=open(filePath+'words.txt')
 		chars = set()
 		bad_samples = []
@@ -89,9 +234,9 @@ class DataLoader:
 			fileNameSplit = lineSplit[0].split('-')
 			fileName = filePath + 'words/' + fileNameSplit[0] + '/' + fileNameSplit[0] + '-' + fileNameSplit[1] + '/' + lineSplit[0] + '.png'
 
-			# GT text are columns starting at 9
-			gtText = self.truncateLabel(' '.join(lineSplit[8:]), maxTextLen)
-			chars = chars.union(set(list(gtText)))
+			# GT text are columns starting at 9, the chars are those of the training targets
+			gtText = ' '.join(lineSplit[8:])
+			chars = chars.union(set(list(self.truncateLabel(gtText, maxTextLen))))
 
 			# check if image is not empty
 			if not os.path.getsize(fileName):
@@ -99,30 +244,45 @@ class DataLoader:
 				continue
 
 			# put sample into list
-			self.samples.append(Sample(gtText, fileName))
+			samples.append(Sample(gtText, fileName))
 
 		# some images in the IAM dataset are known to be damaged, don't show warning for them
 		if set(bad_samples) != set(bad_samples_reference):
 			print("Warning, damaged images found:", bad_samples)
 			print("Damaged images expected:", bad_samples_reference)
 
-		# split into training and validation set: 95% - 5%
-		splitIdx = int(0.95 * len(self.samples))
-		self.trainSamples = self.samples[:splitIdx]
-		self.validationSamples = self.samples[splitIdx:]
-
-		# put words into lists
-		self.trainWords = [x.gtText for x in self.trainSamples]
-		self.validationWords = [x.gtText for x in self.validationSamples]
-
-		# number of randomly chosen samples per epoch for training
-		self.numTrainSamplesPerEpoch = 25000
-
-		# start with train set
-		self.trainSet()
-
-		# list of all chars in dataset
-		self.charList = sorted(list(chars))
+		return (samples, chars)
+
+
+	def readShards(self, filePath, maxTextLen):
+		"samples stored by buildShards in filePath, their images are memory-mapped when loaded"
+		with open(filePath + 'index.json') as f:
+			index = json.load(f)
+		assert tuple(index['imgSize']) == tuple(self.imgSize), 'shards were built for image size %s' % index['imgSize']
+		fnShards = [filePath + name for name in index['shards']]
+		return [Sample(gtText, None, fnShards[shard], offset, (w, h)) for (gtText, shard, offset, w, h) in index['samples']]
+
+
+	def readLabeled(self, filePath, maxTextLen):
+		"samples of a manifest file or of a folder of labeled images"
+		# manifest: lines of image path (relative to the manifest), tab and text
+		# folder: images with their text in <name>.txt
+		samples = []
+		if os.path.isfile(filePath):
+			directory = os.path.dirname(filePath)
+			for line in open(filePath, encoding='utf-8'):
+				if not line.strip() or line[0]=='#':
+					continue
+				(fileName, gtText) = line.rstrip('\n').split('\t', 1)
+				samples.append(Sample(gtText, os.path.join(directory, fileName)))
+		else:
+			for name in sorted(os.listdir(filePath)):
+				(base, ext) = os.path.splitext(name)
+				fnText = os.path.join(filePath, base + '.txt')
+				if ext.lower() in ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff') and os.path.exists(fnText):
+					gtText = open(fnText, encoding='utf-8').read().strip()
+					samples.append(Sample(gtText, os.path.join(filePath, name)))
+		return samples
 
 
 	def truncateLabel(self, text, maxTextLen):
@@ -143,35 +303,91 @@ class DataLoader:
 	def trainSet(self):
 		"switch to randomly chosen subset of training set"
 		self.dataAugmentation = True
-		self.currIdx = 0
-		random.shuffle(self.trainSamples)
+		self.partialBatches = False
+		self.truncateTexts = True
+		self.rawImages = False
+		self.reset()
+		self.rng.shuffle(self.trainSamples)
 		self.samples = self.trainSamples[:self.numTrainSamplesPerEpoch]
+		self.fill()
 
 
-	def validationSet(self):
+	def validationSet(self, rawImages=False):
 		"switch to validation set"
+		# all samples are used, the last batch may be smaller, texts are whole
+		# rawImages -- batches hold the images as read (see ImageBatch) instead of preprocessed ones
 		self.dataAugmentation = False
-		self.currIdx = 0
+		self.partialBatches = True
+		self.truncateTexts = False
+		self.rawImages = rawImages
+		self.reset()
 		self.samples = self.validationSamples
+		self.fill()
+
+
+	def reset(self):
+		"forget the batches loaded ahead"
+		if self.executor is not None:
+			for future in self.pending:
+				future.cancel()
+		self.pending.clear()
+		self.currIdx = 0
+		self.nextIdx = 0
+
+
+	def fill(self):
+		"start loading batches until prefetch of them are pending"
+		while len(self.pending) < self.prefetch and self.nextIdx + self.minBatchSize() <= len(self.samples):
+			if self.sharded:
+				(load, samples) = (loadShardImageBatch if self.rawImages else loadShardBatch, [(self.text(sample), sample.fnShard, sample.offset) + sample.size for sample in self.samples[self.nextIdx:self.nextIdx + self.batchSize]])
+			else:
+				(load, samples) = (loadImageBatch if self.rawImages else loadBatch, [(self.text(sample), sample.filePath) for sample in self.samples[self.nextIdx:self.nextIdx + self.batchSize]])
+			# the seed of each batch is drawn here, in batch order, so that augmentation doesn't depend on which worker loads it
+			augmentationSeed = self.rng.getrandbits(64) if self.dataAugmentation else None
+			if self.executor is None:
+				self.pending.append((load, samples, augmentationSeed))
+			else:
+				self.pending.append(self.executor.submit(load, samples, self.imgSize, augmentationSeed))
+			self.nextIdx += self.batchSize
+
+
+	def text(self, sample):
+		"ground truth text of a sample in the current batches"
+		return self.truncateLabel(sample.gtText, self.maxTextLen) if self.truncateTexts else sample.gtText
+
+
+	def close(self):
+		"stop the workers"
+		self.reset()
+		if self.executor is not None:
+			self.executor.shutdown()
+			self.executor = None
+
+
+	def minBatchSize(self):
+		return 1 if self.partialBatches else self.batchSize
 
 
 	def getIteratorInfo(self):
 		"current batch index and overall number of batches"
-		return (self.currIdx // self.batchSize + 1, len(self.samples) // self.batchSize)
+		return (self.currIdx // self.batchSize + 1, (len(self.samples) + self.batchSize - self.minBatchSize()) // self.batchSize)
 
 
 	def hasNext(self):
 		"iterator"
-		return self.currIdx + self.batchSize <= len(self.samples)
+		return self.currIdx + self.minBatchSize() <= len(self.samples)
 
 
 	def getNext(self):
-		"iterator"
-		batchRange = range(self.currIdx, self.currIdx + self.batchSize)
-		gtTexts = [self.samples[i].gtText for i in batchRange]
-		imgs = [preprocess(cv2.imread(self.samples[i].filePath, cv2.IMREAD_GRAYSCALE), self.imgSize, self.dataAugmentation) for i in batchRange]
+		"iterator, the batch was loaded ahead by the workers unless they can't keep up"
+		self.fill()
+		pending = self.pending.popleft()
 		self.currIdx += self.batchSize
-		return Batch(gtTexts, imgs)
+		self.fill()
+		if self.executor is None:
+			(load, samples, augmentationSeed) = pending
+			return load(samples, self.imgSize, augmentationSeed)
+		return pending.result()
 
 ###DataLoader###
 
@@ -183,6 +399,12 @@ class DecoderType:
 	WordBeamSearch = 2
 
 
+class InferenceMode:
+	Text = 0 # recognized texts only
+	Confidence = 1 # texts and their probability
+	Logits = 2 # texts and the raw RNN output
+
+
 class Model:
 	"minimalistic TF model for HTR"
 
@@ -190,36 +412,98 @@ class Model:
 	batchSize = 50
 	imgSize = (128, 32)
 	maxTextLen = 32
+	widthBuckets = (64, 128, 192, 256) # input widths accepted for inference, one time step per imgSize[0] / maxTextLen pixels
+	defaultWidthBuckets = (imgSize[0],) # widths of recognizers unless given: the training width only, until a CER comparison shows the other widths don't cost accuracy
+	precisions = ('float32', 'float16', 'int8-weights', 'int8') # precisions of the exported frozen graphs
 
-	def __init__(self, charList, decoderType=DecoderType.BestPath, mustRestore=False):
-		"init model: add CNN, RNN and CTC and initialize TF"
+	def __init__(self, charList, decoderType=DecoderType.BestPath, mustRestore=False, inferenceOnly=False, frozenGraph=None, wordBeamSearch=None):
+		"init model: add CNN, RNN and CTC and initialize TF, without loss and optimizer if inferenceOnly, or from an exported frozen graph, wordBeamSearch is the WordBeamSearch decoder to use instead of the default one"
 		self.charList = charList
+		self.charIds = {char: i for (i, char) in reversed(list(enumerate(charList)))} # first id of each char, as charList.index
+		self.charArray = np.array(list(charList)) # chars indexed by label
 		self.decoderType = decoderType
+		self.wordBeamSearch = wordBeamSearch
 		self.mustRestore = mustRestore
+		self.inferenceOnly = inferenceOnly or frozenGraph is not None
+		self.frozenGraph = frozenGraph
 		self.snapID = 0
 
-		# Whether to use normalization over a batch or a population
-		self.is_train = tf.placeholder(tf.bool, name='is_train')
+		if frozenGraph is not None:
+			# input image batch and RNN output come from the frozen graph
+			self.importFrozenGraph(frozenGraph)
+		else:
+			# Whether to use normalization over a batch or a population, always the population for inference
+			self.is_train = False if self.inferenceOnly else tf.placeholder(tf.bool, name='is_train')
+
+			# input image batch
+			self.inputImgs = tf.placeholder(tf.float32, shape=(None, None, Model.imgSize[1]), name='input')
 
-		# input image batch
-		self.inputImgs = tf.placeholder(tf.float32, shape=(None, Model.imgSize[0], Model.imgSize[1]))
+			# setup CNN and RNN
+			self.setupCNN()
+			self.setupRNN()
 
-		# setup CNN, RNN and CTC
-		self.setupCNN()
-		self.setupRNN()
+		# setup CTC
 		self.setupCTC()
 
 		# setup optimizer to train NN
-		self.batchesTrained = 0
-		self.learningRate = tf.placeholder(tf.float32, shape=[])
-		self.update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
-		with tf.control_dependencies(self.update_ops):
-			self.optimizer = tf.train.RMSPropOptimizer(self.learningRate).minimize(self.loss)
+		if not self.inferenceOnly:
+			self.batchesTrained = 0
+			self.learningRate = tf.placeholder(tf.float32, shape=[])
+			self.update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+			with tf.control_dependencies(self.update_ops):
+				self.optimizer = tf.train.RMSPropOptimizer(self.learningRate).minimize(self.loss)
 
 		# initialize TF
 		(self.sess, self.saver) = self.setupTF()
 
 
+	def importFrozenGraph(self, fnGraph):
+		"load the graph written by exportFrozenGraph, its weights are constants"
+		graphDef = tf.GraphDef()
+		with open(fnGraph, 'rb') as f:
+			graphDef.ParseFromString(f.read())
+		(self.inputImgs, self.ctcIn3dTBC) = tf.import_graph_def(graphDef, return_elements=['input:0', 'ctcIn3dTBC:0'], name='')
+
+		# float16 graphs: float32 input batches are converted when fed, the RNN output is decoded as float32
+		if self.ctcIn3dTBC.dtype != tf.float32:
+			self.ctcIn3dTBC = tf.cast(self.ctcIn3dTBC, tf.float32)
+
+
+	def exportFrozenGraph(self, fnGraph, precision='float32'):
+		"write the inference graph from input to RNN output with the weights turned into constants and constant subgraphs folded, precision is one of Model.precisions"
+		# float16: weights and computations in half precision
+		# int8-weights: weights stored as 8 bit and turned back into float32 when the graph is loaded
+		# int8: 8 bit weights and 8 bit computations for the ops that have quantized kernels (convolutions, ReLU, pooling)
+		from tensorflow.tools.graph_transforms import TransformGraph
+		assert precision in Model.precisions, 'unknown precision ' + precision
+		graphDef = tf.graph_util.convert_variables_to_constants(self.sess, self.sess.graph.as_graph_def(), ['ctcIn3dTBC'])
+		transforms = ['strip_unused_nodes', 'fold_constants(ignore_errors=true)', 'fold_old_batch_norms']
+		if precision == 'int8-weights':
+			transforms += ['quantize_weights']
+		elif precision == 'int8':
+			transforms += ['quantize_weights', 'quantize_nodes', 'strip_unused_nodes', 'sort_by_execution_order']
+		graphDef = TransformGraph(graphDef, ['input'], ['ctcIn3dTBC'], transforms)
+		if precision == 'float16':
+			graphDef = self.convertToHalf(graphDef)
+		with open(fnGraph, 'wb') as f:
+			f.write(graphDef.SerializeToString())
+
+
+	def convertToHalf(self, graphDef):
+		"the graph with every float32 type and constant turned into float16"
+		from tensorflow.core.framework import types_pb2
+		for node in graphDef.node:
+			for attr in node.attr.values():
+				if attr.type == types_pb2.DT_FLOAT:
+					attr.type = types_pb2.DT_HALF
+				for (i, dtype) in enumerate(attr.list.type):
+					if dtype == types_pb2.DT_FLOAT:
+						attr.list.type[i] = types_pb2.DT_HALF
+				if attr.HasField('tensor') and attr.tensor.dtype == types_pb2.DT_FLOAT:
+					attr.tensor.CopyFrom(tf.make_tensor_proto(tf.make_ndarray(attr.tensor).astype(np.float16), dtype=tf.float16))
+		return graphDef
+
+
 	def setupCNN(self):
 		"create CNN layers and return output of these layers"
 		cnnIn4d = tf.expand_dims(input=self.inputImgs, axis=3)
@@ -268,34 +552,27 @@ class Model:
 	def setupCTC(self):
 		"create CTC loss and decoder and return them"
 		# BxTxC -> TxBxC
-		self.ctcIn3dTBC = tf.transpose(self.rnnOut3d, [1, 0, 2])
-		# ground truth text as sparse tensor
-		self.gtTexts = tf.SparseTensor(tf.placeholder(tf.int64, shape=[None, 2]) , tf.placeholder(tf.int32, [None]), tf.placeholder(tf.int64, [2]))
-
-		# calc loss for batch
+		if self.frozenGraph is None:
+			self.ctcIn3dTBC = tf.transpose(self.rnnOut3d, [1, 0, 2], name='ctcIn3dTBC')
 		self.seqLen = tf.placeholder(tf.int32, [None])
-		self.loss = tf.reduce_mean(tf.nn.ctc_loss(labels=self.gtTexts, inputs=self.ctcIn3dTBC, sequence_length=self.seqLen, ctc_merge_repeated=True))
 
-		# calc loss for each element to compute label probability
-		self.savedCtcInput = tf.placeholder(tf.float32, shape=[Model.maxTextLen, None, len(self.charList) + 1])
-		self.lossPerElement = tf.nn.ctc_loss(labels=self.gtTexts, inputs=self.savedCtcInput, sequence_length=self.seqLen, ctc_merge_repeated=True)
+		if not self.inferenceOnly:
+			# ground truth text as sparse tensor
+			self.gtTexts = tf.SparseTensor(tf.placeholder(tf.int64, shape=[None, 2]) , tf.placeholder(tf.int32, [None]), tf.placeholder(tf.int64, [2]))
 
-		# decoder: either best path decoding or beam search decoding
+			# calc loss for batch
+			self.loss = tf.reduce_mean(tf.nn.ctc_loss(labels=self.gtTexts, inputs=self.ctcIn3dTBC, sequence_length=self.seqLen, ctc_merge_repeated=True))
+
+		# decoder: best path decoding is done in numpy on the fetched RNN output (see bestPathDecode), or beam search decoding
 		if self.decoderType == DecoderType.BestPath:
-			self.decoder = tf.nn.ctc_greedy_decoder(inputs=self.ctcIn3dTBC, sequence_length=self.seqLen)
+			self.decoder = None
 		elif self.decoderType == DecoderType.BeamSearch:
 			self.decoder = tf.nn.ctc_beam_search_decoder(inputs=self.ctcIn3dTBC, sequence_length=self.seqLen, beam_width=50, merge_repeated=False)
 		elif self.decoderType == DecoderType.WordBeamSearch:
-			# import compiled word beam search operation (see https://github.com/githubharald/CTCWordBeamSearch)
-			word_beam_search_module = tf.load_op_library('TFWordBeamSearch.so')
-
-			# prepare information about language (dictionary, characters in dataset, characters forming words)
-			chars = str().join(self.charList)
-			wordChars = open('./Classification/model/wordCharList.txt').read().splitlines()[0]
-			corpus = open('./Classification/data/corpus.txt').read()
-
-			# decode using the "Words" mode of word beam search
-			self.decoder = word_beam_search_module.word_beam_search(tf.nn.softmax(self.ctcIn3dTBC, dim=2), 50, 'Words', 0.0, corpus.encode('utf8'), chars.encode('utf8'), wordChars.encode('utf8'))
+			# word beam search is done in numpy on the softmax of the fetched RNN output, with the prefix tree of the corpus words saved once
+			self.decoder = None
+			if self.wordBeamSearch is None:
+				self.wordBeamSearch = WordBeamSearch.load(FilePaths.fnCorpusIndex, FilePaths.fnCorpus, FilePaths.fnCharList, FilePaths.fnWordCharList)
 
 
 	def setupTF(self):
@@ -305,6 +582,11 @@ class Model:
 
 		sess=tf.Session() # TF session
 
+		# frozen graph: weights are already part of the graph
+		if self.frozenGraph is not None:
+			print('Init with frozen graph ' + self.frozenGraph)
+			return (sess, None)
+
 		saver = tf.train.Saver(max_to_keep=1) # saver saves model to file
 		modelDir = './Classification/model/'
 		latestSnapshot = tf.train.latest_checkpoint(modelDir) # is there a saved model?
@@ -324,53 +606,52 @@ class Model:
 		return (sess,saver)
 
 
+	def encode(self, text):
+		"string of labels (i.e. class-ids) of a text"
+		return [self.charIds[c] for c in text]
+
+
 	def toSparse(self, texts):
 		"put ground truth texts into sparse tensor for ctc_loss"
-		indices = []
-		values = []
-		shape = [len(texts), 0] # last entry must be max(labelList[i])
-
-		# go over all texts
-		for (batchElement, text) in enumerate(texts):
-			# convert to string of label (i.e. class-ids)
-			labelStr = [self.charList.index(c) for c in text]
-			# sparse tensor must have size of max. label-string
-			if len(labelStr) > shape[1]:
-				shape[1] = len(labelStr)
-			# put each label into sparse tensor
-			for (i, label) in enumerate(labelStr):
-				indices.append([batchElement, i])
-				values.append(label)
+		labelStrs = [self.encode(text) for text in texts]
+		lengths = np.array([len(labelStr) for labelStr in labelStrs], dtype=np.int64)
+
+		# one [batchElement, position] index per label, sparse tensor must have size of max. label-string
+		indices = np.stack([np.repeat(np.arange(len(texts)), lengths), np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)], axis=1)
+		values = np.array([label for labelStr in labelStrs for label in labelStr], dtype=np.int32)
+		shape = [len(texts), int(lengths.max()) if len(texts) else 0]
 
 		return (indices, values, shape)
 
 
+	def bestPathDecode(self, ctcInput, seqLen):
+		"texts of the RNN output (TxBxC): most likely class of each time step, repeated classes collapsed and blanks dropped"
+		(maxT, numBatchElements, numClasses) = ctcInput.shape
+		blank = numClasses - 1
+		best = np.argmax(ctcInput, axis=2).T # BxT
+
+		# keep a class where it starts, if it is no blank and within the sequence length of its batch element
+		keep = best != blank
+		keep[:, 1:] &= best[:, 1:] != best[:, :-1]
+		keep &= np.arange(maxT)[None, :] < np.asarray(seqLen)[:, None]
+		return [str().join(self.charArray[best[b][keep[b]]]) for b in range(numBatchElements)]
+
+
 	def decoderOutputToText(self, ctcOutput, batchSize):
 		"extract texts from output of CTC decoder"
 
 		# contains string of labels for each batch element
 		encodedLabelStrs = [[] for i in range(batchSize)]
 
-		# word beam search: label strings terminated by blank
-		if self.decoderType == DecoderType.WordBeamSearch:
-			blank=len(self.charList)
-			for b in range(batchSize):
-				for label in ctcOutput[b]:
-					if label==blank:
-						break
-					encodedLabelStrs[b].append(label)
-
 		# TF decoders: label strings are contained in sparse tensor
-		else:
-			# ctc returns tuple, first element is SparseTensor
-			decoded=ctcOutput[0][0]
+		# ctc returns tuple, first element is SparseTensor
+		decoded=ctcOutput[0][0]
 
-			# go over all indices and save mapping: batch -> values
-			idxDict = { b : [] for b in range(batchSize) }
-			for (idx, idx2d) in enumerate(decoded.indices):
-				label = decoded.values[idx]
-				batchElement = idx2d[0] # index according to [b,t]
-				encodedLabelStrs[batchElement].append(label)
+		# go over all indices and save mapping: batch -> values
+		for (idx, idx2d) in enumerate(decoded.indices):
+			label = decoded.values[idx]
+			batchElement = idx2d[0] # index according to [b,t]
+			encodedLabelStrs[batchElement].append(label)
 
 		# map labels to chars for all batch elements
 		return [str().join([self.charList[c] for c in labelStr]) for labelStr in encodedLabelStrs]
@@ -382,32 +663,89 @@ class Model:
 		sparse = self.toSparse(batch.gtTexts)
 		rate = 0.01 if self.batchesTrained < 10 else (0.001 if self.batchesTrained < 10000 else 0.0001) # decay learning rate
 		evalList = [self.optimizer, self.loss]
-		feedDict = {self.inputImgs : batch.imgs, self.gtTexts : sparse , self.seqLen : [Model.maxTextLen] * numBatchElements, self.learningRate : rate, self.is_train: True}
+		feedDict = {self.inputImgs : batch.imgs, self.gtTexts : sparse , self.seqLen : self.sequenceLength(batch), self.learningRate : rate, self.is_train: True}
 		(_, lossVal) = self.sess.run(evalList, feedDict)
 		self.batchesTrained += 1
 		return lossVal
 
 
-	def inferBatch(self, batch, calcProbability=False, probabilityOfGT=False):
-		"feed a batch into the NN to recognize the texts"
+	def sequenceLength(self, batch):
+		"number of RNN time steps for each batch element, the CNN keeps one step per imgSize[0] / maxTextLen pixels of width"
+		return [batch.imgs.shape[1] * Model.maxTextLen // Model.imgSize[0]] * len(batch.imgs)
 
-		# decode, optionally save RNN output
+
+	def softmax(self, ctcInput):
+		"probabilities of the classes from the RNN output (TxBxC)"
+		probs = np.exp(ctcInput - np.max(ctcInput, axis=2, keepdims=True))
+		return probs / np.sum(probs, axis=2, keepdims=True)
+
+
+	def labelingProbability(self, ctcInput, texts):
+		"probability of each text given the RNN output (TxBxC), i.e. exp(-ctc_loss), computed with the CTC forward pass in numpy"
+		(maxT, numBatchElements, numClasses) = ctcInput.shape
+		blank = numClasses - 1
+
+		probs = self.softmax(ctcInput)
+
+		# labels with blanks inserted between them and around them: -a-b-
+		labels = [self.encode(text) for text in texts]
+		numStates = 2 * max([len(label) for label in labels] + [0]) + 1
+		extended = np.full([numBatchElements, numStates], blank)
+		for (b, label) in enumerate(labels):
+			extended[b, 1:2 * len(label):2] = label
+		lengths = np.array([2 * len(label) + 1 for label in labels])
+		valid = np.arange(numStates)[None, :] < lengths[:, None]
+
+		# a transition may skip the blank between two different labels
+		skip = np.zeros([numBatchElements, numStates], dtype=bool)
+		skip[:, 2:] = (extended[:, 2:] != blank) & (extended[:, 2:] != extended[:, :-2])
+
+		# forward variables, initialized with the first blank and the first label
+		alpha = np.zeros([numBatchElements, numStates])
+		alpha[:, :2] = np.take_along_axis(probs[0], extended[:, :2], axis=1)
+		alpha[~valid] = 0
+		for t in range(1, maxT):
+			prev = alpha.copy()
+			prev[:, 1:] += alpha[:, :-1]
+			prev[:, 2:] += np.where(skip[:, 2:], alpha[:, :-2], 0)
+			alpha = prev * np.take_along_axis(probs[t], extended, axis=1)
+			alpha[~valid] = 0
+
+		# paths end in the last label or in the last blank
+		rows = np.arange(numBatchElements)
+		return alpha[rows, lengths - 1] + np.where(lengths > 1, alpha[rows, np.maximum(lengths - 2, 0)], 0)
+
+
+	def inferBatch(self, batch, calcProbability=False, probabilityOfGT=False, returnLogits=False):
+		"feed a batch into the NN to recognize the texts, the RNN output is fetched for best path decoding or if probabilities or logits are asked for"
+
+		# decode in TF or fetch the RNN output to decode it in numpy, optionally save RNN output
 		numBatchElements = len(batch.imgs)
-		evalList = [self.decoder] + ([self.ctcIn3dTBC] if calcProbability else [])
-		feedDict = {self.inputImgs : batch.imgs, self.seqLen : [Model.maxTextLen] * numBatchElements, self.is_train: False}
-		evalRes = self.sess.run([self.decoder, self.ctcIn3dTBC], feedDict)
-		decoded = evalRes[0]
-		texts = self.decoderOutputToText(decoded, numBatchElements)
+		seqLen = self.sequenceLength(batch)
+		fetchLogits = calcProbability or returnLogits or self.decoder is None
+		evalList = ([self.decoder] if self.decoder is not None else []) + ([self.ctcIn3dTBC] if fetchLogits else [])
+		feedDict = {self.inputImgs : batch.imgs, self.seqLen : seqLen}
+		if not self.inferenceOnly:
+			feedDict[self.is_train] = False
+		with tracing.span('classification.sessRun', batch=numBatchElements, width=batch.imgs.shape[1]):
+			evalRes = self.sess.run(evalList, feedDict)
+		with tracing.span('classification.decode', decoder=self.decoderType, batch=numBatchElements):
+			if self.decoderType == DecoderType.WordBeamSearch:
+				texts = self.wordBeamSearch.decode(self.softmax(evalRes[-1]), seqLen)
+			elif self.decoder is None:
+				texts = self.bestPathDecode(evalRes[-1], seqLen)
+			else:
+				texts = self.decoderOutputToText(evalRes[0], numBatchElements)
+		tracing.count('classification.batches')
+		tracing.count('classification.words', numBatchElements)
 
-		# feed RNN output and recognized text into CTC loss to compute labeling probability
+		# labeling probability of the recognized (or ground truth) texts from the fetched RNN output
 		probs = None
 		if calcProbability:
-			sparse = self.toSparse(batch.gtTexts) if probabilityOfGT else self.toSparse(texts)
-			ctcInput = evalRes[1]
-			evalList = self.lossPerElement
-			feedDict = {self.savedCtcInput : ctcInput, self.gtTexts : sparse, self.seqLen : [Model.maxTextLen] * numBatchElements, self.is_train: False}
-			lossVals = self.sess.run(evalList, feedDict)
-			probs = np.exp(-lossVals)
+			probs = self.labelingProbability(evalRes[-1], batch.gtTexts if probabilityOfGT else texts)
+
+		if returnLogits:
+			return (texts, probs, evalRes[-1])
 		return (texts, probs)
 
 
@@ -423,8 +761,17 @@ class FilePaths:
 	fnCharList = './Classification/model/charList.txt'
 	fnAccuracy = './Classification/model/accuracy.txt'
 	fnTrain = './Classification/data/'
-	fnInfer = './out/'
 	fnCorpus = './Classification/data/corpus.txt'
+	fnWordCharList = './Classification/model/wordCharList.txt'
+	fnCorpusIndex = './Classification/model/corpusIndex.npz'
+	fnFrozenGraph = './Classification/model/frozen.pb'
+
+	@staticmethod
+	def frozenGraph(precision='float32'):
+		"file of the frozen graph exported with precision"
+		if precision == 'float32':
+			return FilePaths.fnFrozenGraph
+		return './Classification/model/frozen-%s.pb' % precision
 
 
 def train(model, loader):
@@ -440,11 +787,15 @@ def train(model, loader):
 		# train
 		print('Train NN')
 		loader.trainSet()
+		waited = 0 # time spent waiting for batches instead of training
 		while loader.hasNext():
 			iterInfo = loader.getIteratorInfo()
+			start = time.time()
 			batch = loader.getNext()
+			waited += time.time() - start
 			loss = model.trainBatch(batch)
 			print('Batch:', iterInfo[0],'/', iterInfo[1], 'Loss:', loss)
+		print('Waited %.1f s for training data' % waited)
 
 		# validate
 		charErrorRate = validate(model, loader)
@@ -470,52 +821,257 @@ def validate(model, loader):
 	"validate NN"
 	print('Validate NN')
 	loader.validationSet()
+	report = measure(lambda batch: model.inferBatch(batch)[0], loader)
+	print('Character error rate: %f%%. Word accuracy: %f%%.' % (report['charErrorRate']*100.0, report['wordAccuracy']*100.0))
+	return report['charErrorRate']
+
+
+def evaluate(recognizer, loader, verbose=False):
+	"evaluate recognizer on the validation set"
+	# images are recognized as read through recognizer.recognize, as in the pipeline (width buckets, preprocessing, cache)
+	# returns the character error rate, word accuracy, throughput and batch latencies, the errors are printed if verbose
+	loader.validationSet(rawImages=True)
+	report = measure(lambda batch: recognizer.recognize(batch.imgs), loader, verbose)
+	report['recognizer'] = recognizer.settings()
+	return report
+
+
+def measure(recognize, loader, verbose=False):
+	"error rates and timing of recognize on the remaining batches"
+	# recognize(batch) returns the texts of a batch of loader
 	numCharErr = 0
 	numCharTotal = 0
 	numWordOK = 0
 	numWordTotal = 0
+	latencies = [] # recognition time of each batch
+	waited = 0 # time spent waiting for batches
+	start = time.perf_counter()
 	while loader.hasNext():
-		iterInfo = loader.getIteratorInfo()
-		print('Batch:', iterInfo[0],'/', iterInfo[1])
+		waitStart = time.perf_counter()
 		batch = loader.getNext()
-		(recognized, _) = model.inferBatch(batch)
+		inferStart = time.perf_counter()
+		waited += inferStart - waitStart
+		recognized = recognize(batch)
+		latencies.append(time.perf_counter() - inferStart)
 
-		print('Ground truth -> Recognized')
 		for i in range(len(recognized)):
 			numWordOK += 1 if batch.gtTexts[i] == recognized[i] else 0
 			numWordTotal += 1
 			dist = editdistance.eval(recognized[i], batch.gtTexts[i])
 			numCharErr += dist
 			numCharTotal += len(batch.gtTexts[i])
-			print('[OK]' if dist==0 else '[ERR:%d]' % dist,'"' + batch.gtTexts[i] + '"', '->', '"' + recognized[i] + '"')
-
-	# print validation result
-	charErrorRate = numCharErr / numCharTotal
-	wordAccuracy = numWordOK / numWordTotal
-	print('Character error rate: %f%%. Word accuracy: %f%%.' % (charErrorRate*100.0, wordAccuracy*100.0))
-	return charErrorRate
+			if verbose and dist:
+				print('[ERR:%d]' % dist,'"' + batch.gtTexts[i] + '"', '->', '"' + recognized[i] + '"')
+	elapsed = time.perf_counter() - start
+	if numCharTotal == 0:
+		raise Exception('No ground truth chars to compare with, the validation set is empty')
+
+	latenciesMs = np.array(latencies or [0]) * 1000
+	return {'words': numWordTotal,
+		'charErrorRate': numCharErr / numCharTotal,
+		'wordAccuracy': numWordOK / numWordTotal,
+		'wordsPerSecond': numWordTotal / elapsed if elapsed > 0 else 0.0,
+		'seconds': elapsed,
+		'dataWaitSeconds': waited,
+		'batches': len(latencies),
+		'batchSize': loader.batchSize,
+		'batchLatencyMs': {'p50': float(np.percentile(latenciesMs, 50)), 'p90': float(np.percentile(latenciesMs, 90)), 'p99': float(np.percentile(latenciesMs, 99)), 'max': float(latenciesMs.max())}}
+
+
+def freeze(fnGraph, precision='float32'):
+	"export the saved snapshot as a frozen inference graph with the given precision"
+	with tf.Graph().as_default():
+		model = Model(open(FilePaths.fnCharList).read(), mustRestore=True, inferenceOnly=True)
+		model.exportFrozenGraph(fnGraph, precision)
+		model.sess.close()
 
 
 def infer(model, fnImg):
 	"recognize text in image provided by file path"
-	img = preprocess(cv2.imread(fnImg, cv2.IMREAD_GRAYSCALE), Model.imgSize)
+	return inferImage(model, cv2.imread(fnImg, cv2.IMREAD_GRAYSCALE))
+
+
+def inferImage(model, img):
+	"recognize text in a grayscale word image"
+	img = preprocess(img, Model.imgSize)
 	batch = Batch(None, [img])
-	(recognized, probability) = model.inferBatch(batch, True)
+	(recognized, _) = model.inferBatch(batch)
 	# print('Recognized:', '"' + recognized[0] + '"')
-	# print('Probability:', probability[0])
 	return(recognized[0])
 
-def classify():
-	decoderType = DecoderType.BestPath
+class Recognizer:
+	"recognition engine kept for the whole process"
+	# owns the TF graph, session and restored weights, reusable across pages and threads
 
+	def __init__(self, decoderType=DecoderType.BestPath, batchSize=Model.batchSize, frozenGraph=None, widthBuckets=Model.defaultWidthBuckets, cache=None, wordBeamSearch=None):
+		"build the inference-only model in its own graph"
+		# frozenGraph -- exported graph to load instead of restoring the saved snapshot
+		# cache -- recognized words are looked up there first if given
+		# wordBeamSearch -- configuration of the word beam search decoder
+		self.batchSize = batchSize
+		self.widthBuckets = sorted(widthBuckets)
+		self.decoderType = decoderType
+		self.graphStamp = 'snapshot' # weights of the snapshot are part of the cache version, those of a frozen graph aren't
+		if frozenGraph is not None:
+			with open(frozenGraph, 'rb') as f:
+				self.graphStamp = hashlib.sha1(f.read()).hexdigest()[:12]
+		self.cache = cache
+		self.lock = threading.Lock()
+		self.graph = tf.Graph()
+		with self.graph.as_default():
+			self.model = Model(open(FilePaths.fnCharList).read(), decoderType, mustRestore=True, inferenceOnly=True, frozenGraph=frozenGraph, wordBeamSearch=wordBeamSearch)
+
+
+	def bucketWidth(self, img):
+		"smallest input width holding the image scaled to the model height, the widest bucket if none does"
+		if img is None:
+			return self.widthBuckets[0]
+		(h, w) = img.shape[:2]
+		scaledWidth = w * Model.imgSize[1] / max(h, 1)
+		for width in self.widthBuckets:
+			if width >= scaledWidth:
+				return width
+		return self.widthBuckets[-1]
+
+
+	def settings(self):
+		"description of what changes the recognized texts, besides the weights of the snapshot"
+		settings = 'graph=%s;widths=%s;decoder=%d' % (self.graphStamp, ','.join(map(str, self.widthBuckets)), self.decoderType)
+		if self.decoderType == DecoderType.WordBeamSearch:
+			return settings + ';' + self.model.wordBeamSearch.settings()
+		return settings
+
+
+	def recognize(self, images, batchSize=None, mode=InferenceMode.Text):
+		"recognize grayscale word images"
+		# images are batched by input width, results keep their order
+		# mode -- InferenceMode: texts, (texts, probabilities) or (texts, logits)
+		batchSize = batchSize or self.batchSize
+		widths = [self.bucketWidth(img) for img in images]
+		imgs = [preprocess(img, (width, Model.imgSize[1])) for (img, width) in zip(images, widths)]
+		texts = [None] * len(imgs)
+		extras = [None] * len(imgs)
+
+		# texts of already seen word images, identical model inputs give identical texts
+		keys = None
+		if self.cache is not None and mode == InferenceMode.Text:
+			keys = self.cache.wordKeys(imgs, self.settings())
+			texts = [self.cache.getWord(key) for key in keys]
+		todo = [i for i in range(len(imgs)) if texts[i] is None]
+		tracing.count('classification.cachedWords', len(imgs) - len(todo))
+
+		with self.lock, tracing.span('classification.recognize', words=len(imgs), recognized=len(todo)):
+			if self.model is None:
+				raise Exception('Recognizer is closed')
+			for width in sorted(set(widths[i] for i in todo)):
+				bucket = [i for i in todo if widths[i] == width]
+				for start in range(0, len(bucket), batchSize):
+					indices = bucket[start:start + batchSize]
+					batch = Batch(None, [imgs[i] for i in indices])
+					if mode == InferenceMode.Text:
+						(recognized, batchExtras) = self.model.inferBatch(batch)
+					elif mode == InferenceMode.Confidence:
+						(recognized, batchExtras) = self.model.inferBatch(batch, calcProbability=True)
+					else:
+						(recognized, _, logits) = self.model.inferBatch(batch, returnLogits=True)
+						batchExtras = np.transpose(logits, [1, 0, 2]) # TxBxC -> B items of TxC
+
+					# put results back in the order of the images
+					for (k, i) in enumerate(indices):
+						texts[i] = recognized[k]
+						extras[i] = batchExtras[k] if batchExtras is not None else None
+
+		if keys is not None:
+			for i in todo:
+				self.cache.putWord(keys[i], texts[i])
+
+		if mode == InferenceMode.Text:
+			return texts
+		return (texts, extras)
+
+
+	def isClosed(self):
+		"whether close() was called"
+		return self.model is None
+
+
+	def close(self):
+		"release the TF session, the recognizer can't be used afterwards"
+		with self.lock:
+			if self.model is not None:
+				self.model.sess.close()
+				self.model = None
+
+
+	def __enter__(self):
+		return self
+
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+sharedRecognizer = None
+sharedRecognizerLock = threading.Lock()
+sharedRecognizerOptions = {} # Recognizer arguments of the shared recognizer, see configureRecognizer
+
+def configureRecognizer(**options):
+	"Recognizer arguments (e.g. widthBuckets) of the shared recognizer, used when it is next created"
+	sharedRecognizerOptions.clear()
+	sharedRecognizerOptions.update(options)
+
+
+def getRecognizer():
+	"recognizer shared by the whole process, created on first use with an in-memory recognition cache"
+	global sharedRecognizer
+	with sharedRecognizerLock:
+		if sharedRecognizer is None or sharedRecognizer.isClosed():
+			sharedRecognizer = Recognizer(cache=RecognitionCache(), **sharedRecognizerOptions)
+		return sharedRecognizer
+
+
+def closeRecognizer():
+	"close the shared recognizer if it was created"
+	with sharedRecognizerLock:
+		if sharedRecognizer is not None:
+			sharedRecognizer.close()
+
+
+def classify(images):
+	"recognize the word images of a page, given in reading order, and return the text"
 	result = ""
-
-	model = Model(open(FilePaths.fnCharList).read(), decoderType, mustRestore=True)
-	images = os.listdir(FilePaths.fnInfer)
-
-	for i in range(len(images)):
-		img = "{}.jpg".format(i)
-		image_path = FilePaths.fnInfer + img
-		result += infer(model, image_path) + " "
-
-	return(result)
\ No newline at end of file
+	for text in getRecognizer().recognize(images):
+		result += text + " "
+
+	return(result)
+
+
+if __name__ == "__main__":
+	ap = argparse.ArgumentParser()
+	ap.add_argument("--freeze", nargs="?", const='', default=None, help="export the restored snapshot as a frozen inference graph, to the default file of its precision if no path is given")
+	ap.add_argument("--precision", default="float32", choices=Model.precisions, help="precision of the weights (and computations) of the frozen graph")
+	ap.add_argument("--train", nargs="?", const=FilePaths.fnTrain, default=None, help="train the model on the IAM formatted dataset in the given folder")
+	ap.add_argument("--workers", type=int, default=4, help="number of threads loading training batches in the background, 0 to load them in the training loop")
+	ap.add_argument("--processes", action="store_true", help="load training batches in processes instead of threads")
+	ap.add_argument("--prefetch", type=int, default=8, help="number of training batches loaded ahead")
+	ap.add_argument("--seed", type=int, default=None, help="seed of the shuffling and of the data augmentation")
+	ap.add_argument("--build-shards", default=None, metavar="OUT_DIR", help="store the fitted images of the --train dataset (or of the default one) in shards, train from OUT_DIR afterwards")
+	args = vars(ap.parse_args())
+
+	if args["build_shards"]:
+		loader = DataLoader(os.path.join(args["train"] or FilePaths.fnTrain, ''), Model.batchSize, Model.imgSize, Model.maxTextLen, workers=0)
+		buildShards(loader, args["build_shards"], workers=max(args["workers"], 1))
+		sys.exit(0)
+
+	if args["train"]:
+		loader = DataLoader(os.path.join(args["train"], ''), Model.batchSize, Model.imgSize, Model.maxTextLen, args["workers"], args["prefetch"], args["processes"], args["seed"])
+		open(FilePaths.fnCharList, 'w').write(str().join(loader.charList))
+		try:
+			train(Model(loader.charList), loader)
+		finally:
+			loader.close()
+
+	if args["freeze"] is not None:
+		fnGraph = args["freeze"] or FilePaths.frozenGraph(args["precision"])
+		freeze(fnGraph, args["precision"])
+		print('Frozen graph written to ' + fnGraph)
@@ -0,0 +1,86 @@
+import argparse
+import json
+import os
+import re
+import sys
+
+from classification import DataLoader, DecoderType, FilePaths, Model, Recognizer, evaluate, freeze
+
+DECODERS = {'bestpath': DecoderType.BestPath, 'beamsearch': DecoderType.BeamSearch, 'wordbeamsearch': DecoderType.WordBeamSearch}
+
+
+def recordedCharErrorRate(fnAccuracy=FilePaths.fnAccuracy):
+    "validation character error rate of the saved model written by training, None if there is none"
+    if not os.path.exists(fnAccuracy):
+        return None
+    match = re.search(r'([0-9.]+)%', open(fnAccuracy).read())
+    return float(match.group(1)) / 100 if match else None
+
+
+def comparePrecisions(loader, precisions, decoderType, batchSize, cerBudget, verbose=False, **options):
+    "evaluate the frozen graph of each precision (exported first if missing), recommend the fastest one whose CER is within cerBudget of the most accurate one, options are passed to the Recognizer"
+    modes = {}
+    for precision in precisions:
+        fnGraph = FilePaths.frozenGraph(precision)
+        try:
+            if not os.path.exists(fnGraph):
+                freeze(fnGraph, precision)
+            with Recognizer(decoderType, batchSize, fnGraph, **options) as recognizer:
+                report = evaluate(recognizer, loader, verbose)
+        except Exception as e: # e.g. a graph transform unsupported for int8, or no CPU kernel for a float16 or quantized op
+            print('%s: failed (%s)' % (precision, e), file=sys.stderr)
+            modes[precision] = {'error': str(e)}
+            continue
+        report['graphBytes'] = os.path.getsize(fnGraph)
+        modes[precision] = report
+        print('%s: CER %.2f%%, word accuracy %.2f%%, %.1f words/s, batch latency p50 %.1f ms, graph %.1f MB' % (precision, report['charErrorRate'] * 100,
+            report['wordAccuracy'] * 100, report['wordsPerSecond'], report['batchLatencyMs']['p50'], report['graphBytes'] / 2**20), file=sys.stderr)
+
+    evaluated = {precision: report for (precision, report) in modes.items() if 'error' not in report}
+    recommended = None
+    if evaluated:
+        bestCER = min(report['charErrorRate'] for report in evaluated.values())
+        allowed = [precision for (precision, report) in evaluated.items() if report['charErrorRate'] <= bestCER + cerBudget]
+        recommended = max(allowed, key=lambda precision: evaluated[precision]['wordsPerSecond'])
+        print('Fastest within a CER budget of %.2f%%: %s' % (cerBudget * 100, recommended), file=sys.stderr)
+    return {'modes': modes, 'cerBudget': cerBudget, 'recommended': recommended}
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("data", nargs="?", default=FilePaths.fnTrain, help="IAM dataset (its validation split is used), shards folder, folder of word images with <name>.txt texts, or manifest of image path<TAB>text lines")
+    ap.add_argument("-b", "--batch-size", type=int, default=Model.batchSize, help="number of words per recognition batch")
+    ap.add_argument("-w", "--workers", type=int, default=4, help="number of threads loading batches in the background")
+    ap.add_argument("--prefetch", type=int, default=8, help="number of batches loaded ahead")
+    ap.add_argument("-d", "--decoder", default="bestpath", choices=sorted(DECODERS), help="CTC decoder")
+    ap.add_argument("--width-buckets", nargs="+", type=int, default=None, help="input widths of the recognizer, the default ones of the pipeline if not given")
+    ap.add_argument("--frozen", nargs="?", const=FilePaths.fnFrozenGraph, default=None, help="evaluate the exported frozen graph instead of the snapshot")
+    ap.add_argument("--precisions", nargs="+", choices=Model.precisions, default=None, help="compare the frozen graphs of these precisions instead, exported from the snapshot if missing")
+    ap.add_argument("--cer-budget", type=float, default=0.005, help="CER increase over the most accurate precision allowed for the recommended one")
+    ap.add_argument("-o", "--out", default=None, help="file the JSON report is written to, printed if not given")
+    ap.add_argument("-v", "--verbose", action="store_true", help="print the misrecognized words")
+    args = vars(ap.parse_args())
+
+    options = {'widthBuckets': args["width_buckets"]} if args["width_buckets"] else {}
+    path = args["data"] if os.path.isfile(args["data"]) else os.path.join(args["data"], '')
+    loader = DataLoader(path, args["batch_size"], Model.imgSize, Model.maxTextLen, args["workers"], args["prefetch"])
+    try:
+        if args["precisions"]:
+            report = comparePrecisions(loader, args["precisions"], DECODERS[args["decoder"]], args["batch_size"], args["cer_budget"], args["verbose"], **options)
+        else:
+            with Recognizer(DECODERS[args["decoder"]], args["batch_size"], args["frozen"], **options) as recognizer:
+                report = evaluate(recognizer, loader, args["verbose"])
+    finally:
+        loader.close()
+
+    report.update({'data': args["data"], 'decoder': args["decoder"], 'recordedCharErrorRate': recordedCharErrorRate()})
+    if not args["precisions"]:
+        report['frozenGraph'] = args["frozen"]
+        print('%d words: CER %.2f%% (recorded %s), word accuracy %.2f%%, %.1f words/s, batch latency p50 %.1f ms p99 %.1f ms' % (
+            report['words'], report['charErrorRate'] * 100, '%.2f%%' % (report['recordedCharErrorRate'] * 100) if report['recordedCharErrorRate'] is not None else 'none',
+            report['wordAccuracy'] * 100, report['wordsPerSecond'], report['batchLatencyMs']['p50'], report['batchLatencyMs']['p99']), file=sys.stderr)
+    if args["out"]:
+        with open(args["out"], 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -1,20 +1,77 @@
 import sys, os
+import argparse
 import cv2
 
 
 from PyQt5.QtWidgets import QMainWindow, QApplication, QWidget, QPushButton, QFileDialog, QLabel, QLineEdit, QProgressBar, QPlainTextEdit
 from PyQt5.QtGui import QIcon, QPixmap
-from PyQt5.QtCore import QBasicTimer
+from PyQt5.QtCore import QThread, pyqtSignal
 from docx import Document
 from fpdf import FPDF
 from docx.shared import Inches
-import shutil
 
 from segmentation import TextSegmentation
-from preprocessing import Preprocessing
-from classification import classify
+from pipeline import preprocessSteps, pageSettings
+from classification import getRecognizer, closeRecognizer, configureRecognizer
 
 
+class RecognitionWorker(QThread):
+    progress = pyqtSignal(int, str) # percentage, current stage
+    recognized = pyqtSignal(str) # text of the page, not emitted if cancelled
+    failed = pyqtSignal(str)
+
+    def __init__(self, img, parent=None):
+        QThread.__init__(self, parent)
+        self.img = img
+        self.cancelled = False
+
+    def cancel(self):
+        # checked after each preprocessing step, segmented line and recognized batch
+        self.cancelled = True
+
+    def run(self):
+        try:
+            self.progress.emit(0, "Loading model")
+            recognizer = getRecognizer()
+            if self.cancelled:
+                return
+
+            # same page already recognized
+            key = recognizer.cache.pageKey(self.img, pageSettings(recognizer.settings()))
+            text = recognizer.cache.getPage(key)
+            if text is not None:
+                self.progress.emit(100, "Found in cache")
+                self.recognized.emit(text)
+                return
+
+            self.progress.emit(10, "Preprocessing")
+            for (step, page) in preprocessSteps(self.img):
+                if self.cancelled:
+                    return
+                self.progress.emit(15, "Preprocessing: %s done" % step)
+
+            lines = []
+            for words in TextSegmentation(page).iterLines():
+                if self.cancelled:
+                    return
+                lines.append(words)
+                self.progress.emit(30, "Segmenting line %d" % len(lines))
+
+            images = [word.img for words in lines for word in words]
+            texts = []
+            for start in range(0, len(images), recognizer.batchSize):
+                texts += recognizer.recognize(images[start:start + recognizer.batchSize])
+                if self.cancelled:
+                    return
+                self.progress.emit(40 + 60 * len(texts) // max(len(images), 1), "Recognizing word %d/%d" % (len(texts), len(images)))
+
+            text = " ".join(texts)
+            recognizer.cache.putPage(key, text)
+            self.progress.emit(100, "Finished")
+            self.recognized.emit(text)
+        except Exception as e:
+            self.failed.emit(str(e))
+
 
 class Window(QMainWindow):
 
@@ -141,8 +198,11 @@ class Window(QMainWindow):
         self.progressBar.setGeometry(262, 808, 589, 80)
         self.progressBar.setObjectName("progressBar")
 
-        self.timer = QBasicTimer()
-        self.step = 0
+        # recognized text of the current image, shared by all exports
+        self.img = None
+        self.result = None
+        self.worker = None
+        self.pendingExports = []
 
         self.show()
 
@@ -153,6 +213,13 @@ class Window(QMainWindow):
         self.inputBox.setText(self.img)
         self.img = cv2.imread(self.img)
 
+        # new image: forget the previous result and stop its recognition
+        self.result = None
+        self.pendingExports = []
+        if self.worker is not None:
+            self.worker.cancel()
+        self.progressBar.reset()
+
     def saveFile(self):
         options = QFileDialog.Options()
         options |= QFileDialog.DontUseNativeDialog
@@ -160,40 +227,63 @@ class Window(QMainWindow):
         self.outputBox.setText(self.save_destination)
 
     def main(self):
+        if self.img is None or (self.worker is not None and self.worker.isRunning() and not self.worker.cancelled):
+            return
         print("started")
-        p = Preprocessing()
-        resized = p.resize(self.img)
-        denoised = p.denoise(resized)
-        s = TextSegmentation(denoised)
-        s.linesSegmentation()
-        self.result = classify()
-        shutil.rmtree("./out")
-        print("Finished")
-
+        self.worker = RecognitionWorker(self.img, self)
+        self.worker.progress.connect(self.onProgress)
+        self.worker.recognized.connect(self.onRecognized)
+        self.worker.failed.connect(self.onFailed)
+        self.worker.finished.connect(self.onWorkerFinished)
+        self.startButton.setText('Stop')
+        self.worker.start()
+
+    def onProgress(self, value, stage):
+        if self.sender() is not self.worker:
+            return
+        self.progressBar.setValue(value)
+        self.progressBar.setFormat(stage + " %p%")
 
-    def start(self):
-        pass
+    def onRecognized(self, text):
+        if self.sender() is not self.worker:
+            return # result of an image that was replaced
+        print("Finished")
+        self.result = text
+        exports, self.pendingExports = self.pendingExports, []
+        for export in exports:
+            export()
 
-    def timerEvent(self, e):
-        if self.step >= 100:
-            self.timer.stop()
-            self.startButton.setText('Finished')
+    def onFailed(self, message):
+        if self.sender() is not self.worker:
             return
+        print("Failed: " + message)
+        self.pendingExports = []
+        self.progressBar.setFormat("Failed")
 
-        self.step = self.step + 1
-        self.progressBar.setValue(self.step)
-
+    def onWorkerFinished(self):
+        if self.sender() is self.worker:
+            self.startButton.setText('Finished' if self.result is not None else 'Start')
 
     def doAction(self):
-        if self.timer.isActive():
-            self.timer.stop()
-            self.startButton.setText('Start')
+        if self.worker is not None and self.worker.isRunning():
+            self.worker.cancel()
+            self.pendingExports = []
+            self.progressBar.setFormat("Cancelled")
         else:
-            self.timer.start(100, self)
-            self.startButton.setText('Stop')
+            self.main()
+
+    def export(self, write):
+        # write right away if the image was already recognized, once it is otherwise
+        if self.result is not None:
+            write()
+        elif self.img is not None:
+            self.pendingExports.append(write)
+            self.main()
 
     def save_to_pdf(self):
-        self.main()
+        self.export(self.write_pdf)
+
+    def write_pdf(self):
         pdf = FPDF()
         pdf.add_page()
         pdf.set_xy(10, 10)
@@ -206,7 +296,9 @@ class Window(QMainWindow):
             pdf.output("result.pdf", "F")
 
     def save_to_word(self):
-        self.main()
+        self.export(self.write_word)
+
+    def write_word(self):
         document = Document()
         document.add_paragraph(self.result)
         try:
@@ -216,7 +308,9 @@ class Window(QMainWindow):
             document.save("result.docx")
 
     def save_to_txt(self):
-        self.main()
+        self.export(self.write_txt)
+
+    def write_txt(self):
         try:
             save_destination = self.save_destination + "/result.txt"
             f = open(save_destination, "w+")
@@ -226,6 +320,12 @@ class Window(QMainWindow):
         f.close()
 
 if __name__ == "__main__":
-    app = QApplication(sys.argv)
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--width-buckets", nargs="+", type=int, default=None, help="input widths of the recognizer, the training width only if not given")
+    (args, qtArgs) = ap.parse_known_args()
+    if args.width_buckets:
+        configureRecognizer(widthBuckets=args.width_buckets)
+    app = QApplication(sys.argv[:1] + qtArgs)
     fen = Window()
     app.exec_()
+    closeRecognizer()
@@ -0,0 +1,129 @@
+import cv2
+import argparse
+import sys
+
+import tracing
+from preprocessing import Preprocessing, DirectorySink, DENOISE_MODES
+from segmentation import TextSegmentation
+
+
+class Page:
+    "page image and where it comes from"
+    def __init__(self, path, img):
+        self.path = path
+        self.img = img
+
+
+class Line:
+    "segmented words of one line of a page"
+    def __init__(self, page, lineIndex, words):
+        self.page = page
+        self.lineIndex = lineIndex
+        self.words = words
+
+
+class RecognizedWord:
+    "recognized text of a word and its position in the document"
+    def __init__(self, page, lineIndex, wordIndex, box, text):
+        self.page = page
+        self.lineIndex = lineIndex
+        self.wordIndex = wordIndex
+        self.box = box
+        self.text = text
+
+
+# bumped whenever a change of the preprocessing, segmentation or recognition code changes the text of pages, so that cached pages aren't reused
+PIPELINE_VERSION = 2
+
+
+def pageSettings(recognizerSettings, denoise='nlm', maxSkew=5.0, sharedBinarization=True):
+    "what produces the text of a page besides the model weights, part of the page cache keys, recognizerSettings is Recognizer.settings()"
+    return 'version=%d;resize=1024;denoise=%s;deskew=%g;segmentation=histogram;sharedBinarization=%d;%s' % (PIPELINE_VERSION, denoise, maxSkew, sharedBinarization, recognizerSettings)
+
+
+def preprocessSteps(img, denoise='nlm', sink=None, maxSkew=5.0):
+    "(step name, page) after each step of preprocessPage, the last page is the preprocessed one"
+    p = Preprocessing(sink)
+    resized = p.resize(img)
+    yield ('resize', resized)
+    denoised = p.denoise(resized, denoise)
+    yield ('denoise', denoised)
+    if maxSkew > 0:
+        yield ('rotate', p.rotate(denoised, maxSkew))
+
+
+def preprocessPage(img, denoise='nlm', sink=None, maxSkew=5.0):
+    "preprocessing applied to a page before segmentation, denoise is one of DENOISE_MODES, skews up to maxSkew degrees are corrected (0 to disable), intermediate images go to sink if given"
+    for (_, page) in preprocessSteps(img, denoise, sink, maxSkew):
+        pass
+    return page
+
+
+def readPages(paths):
+    "pages read one at a time, unreadable files are reported and skipped"
+    for path in paths:
+        img = cv2.imread(path)
+        if img is None:
+            print('Could not read ' + str(path), file=sys.stderr)
+            continue
+        yield Page(path, img)
+
+
+def preprocessPages(pages, denoise='nlm', sink=None, maxSkew=5.0):
+    "pages with preprocessPage applied"
+    for page in pages:
+        yield Page(page.path, preprocessPage(page.img, denoise, sink, maxSkew))
+
+
+def segmentLines(pages, sink=None):
+    "lines of each page, a line is segmented into words only when it is requested"
+    for page in pages:
+        for words in TextSegmentation(page.img, sink).iterLines():
+            if words:
+                yield Line(page, words[0].lineIndex, words)
+
+
+def recognizeLines(lines, recognizer):
+    "recognized words, the words of a line are recognized together as one batch"
+    for line in lines:
+        texts = recognizer.recognize([word.img for word in line.words])
+        for (word, text) in zip(line.words, texts):
+            yield RecognizedWord(line.page, word.lineIndex, word.wordIndex, word.box, text)
+
+
+def recognizeDocument(paths, recognizer, denoise='nlm', sink=None, maxSkew=5.0):
+    "recognized words of all pages in reading order: only the current page and line are kept in memory"
+    return recognizeLines(segmentLines(preprocessPages(readPages(paths), denoise, sink, maxSkew), sink), recognizer)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("inputs", nargs="+", help="page images, read in the given order")
+    ap.add_argument("-d", "--denoise", default="nlm", choices=DENOISE_MODES, help="denoising mode")
+    ap.add_argument("-k", "--max-skew", type=float, default=5.0, help="largest page skew corrected, in degrees, 0 to disable")
+    ap.add_argument("--width-buckets", nargs="+", type=int, default=None, help="input widths of the recognizer, the training width only if not given")
+    ap.add_argument("--debug", default=None, help="folder where the intermediate images are saved")
+    ap.add_argument("--trace", default=None, help="file the timing of each stage is written to, as JSON lines if it ends with .jsonl or else as a Chrome trace")
+    args = vars(ap.parse_args())
+    if args["trace"]:
+        tracing.enable(args["trace"])
+    sink = DirectorySink(args["debug"]) if args["debug"] else None
+
+    from classification import Recognizer
+
+    # one output line per text line, written as soon as it is recognized
+    with Recognizer(**({'widthBuckets': args["width_buckets"]} if args["width_buckets"] else {})) as recognizer:
+        current = None
+        for word in recognizeDocument(args["inputs"], recognizer, args["denoise"], sink, args["max_skew"]):
+            if current is not None and current != (word.page.path, word.lineIndex):
+                print(flush=True)
+            elif current is not None:
+                print(' ', end='')
+            print(word.text, end='')
+            current = (word.page.path, word.lineIndex)
+        if current is not None:
+            print(flush=True)
+
+    if args["trace"]:
+        tracing.disable()
+        print(tracing.formatSummary(), file=sys.stderr)
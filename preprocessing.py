@@ -1,28 +1,95 @@
 import cv2
 import numpy as np
 import argparse
+import itertools
 import os
 import shutil
 
-class Preprocessing:
-    def __init__(self):
+import tracing
+
+DENOISE_MODES = ["nlm", "nlm-gray", "bilateral", "median", "none", "auto"]
+
+class NullSink:
+    "drops the intermediate images, used when no debugging output is wanted"
+    def save(self, name, img):
         pass
 
+class MemorySink:
+    "keeps a copy of every intermediate image, by name, in the order they were produced"
+    def __init__(self):
+        self.artifacts = {}
+
+    def save(self, name, img):
+        self.artifacts.setdefault(name, []).append(img.copy())
+
+class DirectorySink:
+    "writes every intermediate image to a directory, numbered so that images with the same name don't overwrite each other"
+    def __init__(self, directory, extension = "png"):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.extension = extension
+        self.counter = itertools.count()
+
+    def save(self, name, img):
+        cv2.imwrite(os.path.join(self.directory, "{:05d}_{}.{}".format(next(self.counter), name, self.extension)), img)
+
+class Preprocessing:
+    def __init__(self, sink = None):
+        # sink -- where the intermediate images go, nowhere by default
+        self.sink = sink if sink is not None else NullSink()
+
+    @tracing.traced("preprocessing.resize")
     def resize(self, img):
         width, length = img.shape[:2]
         factor = min(1, float(1024.0 / length))
         size = int(factor * length), int(factor * width)
         img_resized = cv2.resize(img, size)
 
-        cv2.imwrite("./preprocessing_out/img_resized.png", img_resized)
+        self.sink.save("img_resized", img_resized)
         return(img_resized)
 
 
-    def denoise(self, img):
-        img_denoised = cv2.fastNlMeansDenoisingColored(img,None,10,10,7,21)
-        cv2.imwrite("./preprocessing_out/img_denoised.png", img_denoised)
+    @tracing.traced("preprocessing.denoise")
+    def denoise(self, img, mode="nlm", noiseThreshold=5.0):
+        # mode -- "nlm" (color non-local means), "nlm-gray", "bilateral", "median", "none"
+        #         or "auto": grayscale non-local means only if the estimated noise is above noiseThreshold
+        if mode == "auto":
+            mode = "nlm-gray" if self.estimateNoise(img) > noiseThreshold else "none"
+
+        if mode == "nlm":
+            img_denoised = cv2.fastNlMeansDenoisingColored(img,None,10,10,7,21)
+        elif mode == "nlm-gray":
+            img_denoised = cv2.fastNlMeansDenoising(self.grayscale(img),None,10,7,21)
+        elif mode == "bilateral":
+            img_denoised = cv2.bilateralFilter(img, 9, 75, 75)
+        elif mode == "median":
+            img_denoised = cv2.medianBlur(img, 3)
+        elif mode == "none":
+            img_denoised = img
+        else:
+            raise ValueError("Unknown denoising mode: " + str(mode))
+
+        self.sink.save("img_denoised", img_denoised)
         return(img_denoised)
 
+    def estimateNoise(self, img, maxSize=512):
+        # standard deviation of the gaussian noise (Immerkaer's method) on a pixel subsample of at most maxSize x maxSize
+        gray = self.grayscale(img)
+        step = max(1, max(gray.shape[:2]) // maxSize)
+        sample = gray[::step, ::step].astype(np.float32)
+        height, width = sample.shape
+        if height < 3 or width < 3:
+            return(0.0)
+        laplacian = np.array([[1, -2, 1], [-2, 4, -2], [1, -2, 1]], np.float32)
+        response = cv2.filter2D(sample, -1, laplacian)[1:-1, 1:-1]
+        return(float(np.abs(response).sum() * np.sqrt(0.5 * np.pi) / (6.0 * (width - 2) * (height - 2))))
+
+    def grayscale(self, img):
+        if len(img.shape) == 3:
+            return(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY))
+        return(img)
+
+    @tracing.traced("preprocessing.binarize")
     def binarize(self, img):
         while True:
             try:
@@ -31,7 +98,7 @@ class Preprocessing:
                 kernel_erode = np.ones((2,2),np.uint8)
                 img_binarized = cv2.erode(binarized, kernel_erode, iterations = 1)
 
-                cv2.imwrite("./preprocessing_out/binarized.png", img_binarized)
+                self.sink.save("binarized", img_binarized)
                 return(img_binarized, grayscaled)
                 break
 
@@ -40,33 +107,55 @@ class Preprocessing:
                 kernel_erode = np.ones((2,2),np.uint8)
                 img_binarized = cv2.erode(binarized, kernel_erode, iterations = 1)
 
-                cv2.imwrite("./preprocessing_out/binarized.png", img_binarized)
+                self.sink.save("binarized", img_binarized)
                 return(img_binarized, img)
 
-    def rotate(self, img):
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) # convert image color to grayscale
-        gray = cv2.bitwise_not(gray) # change color between background and object
-        thresh = cv2.threshold(gray,0,255,cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1] # binary picture
-        coords = np.column_stack(np.where(thresh > 0)) # where return value depending on condition (everything except black)
-    # column stack take those value and convert 1D-array in 2D-array
-        angle = cv2.minAreaRect(coords)[-1] # calculate angle with coords
-        if angle < -45:
-            angle = -(90 + angle)
+    def estimateSkew(self, img, maxAngle=5.0, step=0.25, maxSize=512):
+        # angle in degrees, within [-maxAngle, maxAngle], that makes the text lines horizontal once given to cv2.getRotationMatrix2D
+        # the page is reduced to at most maxSize x maxSize, so the cost and memory don't depend on the page size or the amount of ink
+        gray = self.grayscale(img)
+        factor = min(1.0, float(maxSize) / max(gray.shape[:2]))
+        if factor < 1.0:
+            gray = cv2.resize(gray, (max(1, int(gray.shape[1] * factor)), max(1, int(gray.shape[0] * factor))), interpolation = cv2.INTER_AREA)
+        ink = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 11, 16).astype(np.float32)
+        (height, width) = ink.shape
+        center = (width / 2.0, height / 2.0)
+
+        def profileVariance(angle):
+            # lines are sharpest, so the horizontal projection profile varies most, at the right angle
+            m = cv2.getRotationMatrix2D(center, angle, 1.0)
+            rotated = cv2.warpAffine(ink, m, (width, height), flags = cv2.INTER_LINEAR, borderValue = 0)
+            return(float(np.var(rotated.sum(axis = 1))))
+
+        # coarse search with 1 degree steps, then refine around the best angle
+        coarse = np.arange(-maxAngle, maxAngle + 1e-9, max(step, 1.0))
+        best = max(coarse, key = profileVariance)
+        fine = np.arange(max(-maxAngle, best - 1.0), min(maxAngle, best + 1.0) + 1e-9, step)
+        return(float(max(fine, key = profileVariance)))
+
+    @tracing.traced("preprocessing.rotate")
+    def rotate(self, img, maxAngle=5.0, step=0.25, tolerance=None):
+        # maxAngle -- largest skew looked for, in degrees
+        # step -- precision of the estimated skew, the estimates are on a grid of step degrees
+        # tolerance -- skews up to this are left as they are, the page isn't warped, step if None: estimates of 0 and +/-step, which are within the error of the estimate
+        angle = self.estimateSkew(img, maxAngle, step)
+        if abs(angle) <= (step if tolerance is None else tolerance) + 1e-9:
+            img_rotated = img
         else:
-            angle = -angle
-
-        (height, width) = img.shape[:2]
-        center = (width // 2,height // 2)
-        m = cv2.getRotationMatrix2D(center,angle,1.0)
-        (img_rotated) = cv2.warpAffine(img, m, (width, height),flags = cv2.INTER_CUBIC, borderMode = cv2.BORDER_REPLICATE) #Also needs research
+            tracing.count("preprocessing.warped")
+            (height, width) = img.shape[:2]
+            center = (width // 2,height // 2)
+            m = cv2.getRotationMatrix2D(center,angle,1.0)
+            (img_rotated) = cv2.warpAffine(img, m, (width, height),flags = cv2.INTER_LINEAR, borderMode = cv2.BORDER_REPLICATE)
 
-        cv2.imwrite("./preprocessing_out/rotated.png", img_rotated)
+        self.sink.save("rotated", img_rotated)
         return(img_rotated)
 
 
 if __name__ == "__main__":
     ap = argparse.ArgumentParser()
     ap.add_argument("-i", "--image", required=True, help="path to input image file")
+    ap.add_argument("-d", "--denoise", default="nlm", choices=DENOISE_MODES, help="denoising mode")
     args = vars(ap.parse_args())
     img = cv2.imread(args["image"])
 
@@ -77,8 +166,8 @@ if __name__ == "__main__":
         except:
             shutil.rmtree("./preprocessing_out")
 
-    p = Preprocessing()
+    p = Preprocessing(DirectorySink("./preprocessing_out"))
     p.resize(img)
-    p.denoise(img)
+    p.denoise(img, args["denoise"])
     p.binarize(img)
     p.rotate(img)
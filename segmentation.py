@@ -1,117 +1,148 @@
 import cv2
 import numpy as np
 import argparse
-import os # creer dossier
-import shutil # supprime dossier
 from matplotlib import pyplot as plt
-from preprocessing import Preprocessing as p
+from preprocessing import Preprocessing, DirectorySink
 import time
+import tracing
+
+class Word:
+    "image d'un mot découpé et sa position dans la page"
+    def __init__(self, img, lineIndex, wordIndex, box):
+        self.img = img # image du mot en teinte de gris
+        self.lineIndex = lineIndex # numéro de la ligne dans la page
+        self.wordIndex = wordIndex # numéro du mot dans la ligne
+        self.box = box # (x, y, largeur, hauteur) du mot dans la page
+
 
 class TextSegmentation:
 
-    def __init__(self, imgName):
+    def __init__(self, imgName, sink = None, sharedBinarization = True):
+        # imgName -- image de la page
+        # sink -- où envoyer les images intermédiaires (lignes, mots, binarisations) pour le débogage, nulle part si None
+        # sharedBinarization -- binariser et éroder la page une seule fois, les lignes et les mots en utilisent des morceaux
         self.original_img = imgName
+        self.preprocessing = Preprocessing(sink)
+        self.sink = self.preprocessing.sink
+        self.sharedBinarization = sharedBinarization
+        self.binary = None # page binarisée, partagée par les lignes
+        self.erosion = None # page binarisée et érodée, partagée par les mots
 
     #fonction qui enleve les espaces inutiles des images des mots
-    def resizeWord(self, img):
+    @tracing.traced("segmentation.resizeWord")
+    def resizeWord(self, img, erosion = None):
         # img -- image des mots
-        binary, grayscaled = p.binarize(self, img)
-        erosion = cv2.erode(binary, None, iterations = 6)
+        # erosion -- image binarisée et érodée du mot, calculée à partir de img si None
+        # retourne l'image recadrée et sa position (x, y, largeur, hauteur) dans img
+        if erosion is None:
+            binary, grayscaled = self.preprocessing.binarize(img)
+            erosion = cv2.erode(binary, None, iterations = 6)
         bitwise = cv2.bitwise_not(erosion)
         contours, hierarchy = cv2.findContours(bitwise, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
         for c in contours:
             x, y, width, height = cv2.boundingRect(c)
             if width > 30 and height > 30:
                 crop = img[y : y+height , x : x+width]
-                return(crop)
+                return(crop, (x, y, width, height))
+        return(None, None)
 
 # fonction de lissage d'une courbe #
-    def smoothing(self, histogram, p = 20):
+    def smoothing(self, histogram, p = 20, kernel = 'box'):
         # histogram -- liste de valeur de l'histogramme
         # p -- taille du noyau pour effectuer le lissage
-        histogramSmoothing = []
-        for i in range(p):
-            histogramSmoothing.append(0)
-        for i in range(p, len(histogram)-p):
-            val = 0
-            for j in range(2*p):
-                val += histogram[i-p+j]
-            histogramSmoothing.append(val/2/p)
-        for i in range(p):
-            histogramSmoothing.append(0)
+        # kernel -- 'box' (moyenne glissante sur 2p valeurs) ou 'gaussian' (gaussienne de même variance)
+        # le coût est linéaire quelle que soit la taille du noyau (sommes cumulées)
+        histogram = np.asarray(histogram)
+        histogramSmoothing = np.zeros(len(histogram))
+        if len(histogram) <= 2*p:
+            return(histogramSmoothing)
+
+        if kernel == 'box':
+            # somme des valeurs histogram[i-p : i+p] pour p <= i < len-p
+            cumul = np.concatenate(([0], np.cumsum(histogram)))
+            histogramSmoothing[p:-p] = (cumul[2*p:-1] - cumul[:-2*p-1]) / 2 / p
+        elif kernel == 'gaussian':
+            # trois moyennes glissantes successives approchent une gaussienne de même variance que le noyau 'box'
+            variance = ((2*p)**2 - 1) / 12
+            radius = max(int(round((np.sqrt(4*variance + 1) - 1) / 2)), 1)
+            values = histogram.astype(np.float64)
+            for _ in range(3):
+                values = self.boxFilter(values, radius)
+            histogramSmoothing[p:-p] = values[p:-p]
+        else:
+            raise ValueError('Unknown smoothing kernel: ' + str(kernel))
+
+        # les p premières et dernières valeurs restent à zéro
         return(histogramSmoothing)
 
+# fonction de moyenne glissante centrée #
+    def boxFilter(self, values, radius):
+        # values -- valeurs à lisser
+        # radius -- demi largeur de la fenêtre (fenêtre de 2*radius+1 valeurs, zéros hors des bornes)
+        cumul = np.concatenate(([0], np.cumsum(np.pad(values, radius + 1))))
+        return((cumul[2*radius+2:] - cumul[1:-2*radius-1])[:len(values)] / (2*radius + 1))
+
 # fonction de création d'un histogramme horizontal #
     def horizontalHistogram(self, img):
         #img -- image principale
-        heightMax, widthMax = img.shape[:2]
-        histogram = []
-        for height in range(heightMax):
-            counter = 0
-            for width in range(widthMax):
-                if (img[height, width] == 0):
-                    counter += 1 # compte le nombre de pixel noir par ligne
-            histogram.append(counter)
-        return(histogram)
+        # compte le nombre de pixel noir par ligne
+        return(np.count_nonzero(img == 0, axis=1))
 
 # fonction de création d'un histogramme vertical #
     def verticalHistogram(self, img):
         # img -- image principale
-        heightMax, widthMax = img.shape[:2]
-        histogram = []
-        for width in range(widthMax):
-            counter = 0
-            for height in range(heightMax):
-                if (img[height, width] == 0):
-                    counter += 1 # compte le nombre de pixel noir par colonne
-            histogram.append(counter)
-        return(histogram)
+        # compte le nombre de pixel noir par colonne
+        return(np.count_nonzero(img == 0, axis=0))
 
 # fonction pour récupérer les pics inférieurs d'une courbe #
-    def lowerPeak(self, histogram, list, widthMax, seuil) :
+    def lowerPeak(self, histogram, list, widthMax, seuil, minDistance = 0) :
         # histogram -- liste des valeurs de l'histogramme
         # list -- liste de la largeur ou de la hauteur de l'image
         # widthMax -- nombre de pixel noir maximum
         # seuil -- limite à franchir pour déterminer les pics inférieurs (empeche la selection des faux pics inférieurs)
-        bot = [0]
-        progress = 0
-
-        while True :
-            # recherche pic supérieur
-            upper = True
-            min = 0
-            while upper == True :
-                if histogram[progress] >= min :
-                    min = histogram[progress]
-                    progress += 1
-                else :
-                    upper = False
-
-            # recherche pic inférieur
-            max = widthMax
-            lower = True
-            while lower == True :
-                if histogram[progress] <= max :
-                    max = histogram[progress]
-                    progress += 1
-
-                if histogram[progress] > max:
-                    lower = False
-                    if histogram[progress - 1] < seuil :
-                        bot.append(list[progress])
-                        progress += 1
-
-                if progress == list[-1] :
-                    bot.append(list[-1])
-                    return(bot)
+        # minDistance -- écart minimum entre deux coordonnées retenues
+        histogram = np.asarray(histogram)
+        last = len(list) - 1
+        if len(histogram) < 3 :
+            return([list[0], list[last]])
+
+        # position de la dernière descente et de la dernière montée en chaque point
+        slope = np.diff(histogram)
+        steps = np.arange(1, len(histogram))
+        lastDrop = np.maximum.accumulate(np.where(slope < 0, steps, 0))
+        lastRise = np.maximum.accumulate(np.where(slope > 0, steps, 0))
+
+        # un pic inférieur est la fin d'une descente (ou du palier qui la suit) avant une montée
+        valley = np.zeros(len(slope), dtype=bool)
+        valley[1:] = (slope[1:] > 0) & (lastDrop[:-1] > lastRise[:-1])
+        valley &= histogram[:-1] < seuil
+
+        # la coordonnée retenue est le premier point de la montée, la recherche reprend une
+        # position plus loin : la descente suivante doit commencer après celle-ci
+        bot = [list[0]]
+        cut = -1
+        for bottom in np.flatnonzero(valley) :
+            if lastDrop[bottom - 1] < cut + 2 or bottom + 1 >= last :
+                continue
+            if list[bottom + 1] - bot[-1] >= minDistance :
+                cut = bottom + 1
+                bot.append(list[cut])
+        if len(bot) > 1 and list[last] - bot[-1] < minDistance :
+            bot.pop()
+        bot.append(list[last])
+        return(bot)
 
 # fonction segmentation des mots #
-    def wordSegmentation(self, img, counter):
+    @tracing.traced("segmentation.words")
+    def wordSegmentation(self, img, lineIndex = 0, top = 0):
         # img -- image des différentes lignes du texte
-        # counter -- compteur pour le nom des images sauvegardées
-        imgCopy = img.copy()
-        imgBinary, imgGrayscaled = p.binarize(self, img) # binarisation
+        # lineIndex -- numéro de la ligne
+        # top -- ordonnée de la ligne dans la page
         heightMax, widthMax = self.original_img.shape[:2]
+        if self.binary is not None:
+            imgBinary, imgGrayscaled = self.binary[top : top + img.shape[0]], img # morceau de la page binarisée
+        else:
+            imgBinary, imgGrayscaled = self.preprocessing.binarize(img) # binarisation
 
         # creer liste de la largeur de la ligne
         widthList = np.arange(widthMax)
@@ -126,63 +157,82 @@ class TextSegmentation:
         words = self.lowerPeak(histogramSmoothing, widthList, widthMax, seuil=1)
 
         # parcourir les coordonnées de chaque mot pour les extraires
+        wordList = []
         for i in range(len(words)-1):
             cropImg = imgGrayscaled[0 : heightMax, words[i] : words[i+1]] # extraction des mots sur l'image en teinte de gris
             heightCropImg, widthCropImg = cropImg.shape[:2]
             if widthCropImg >= 10:
-                cropWords = self.resizeWord(cropImg)
-                cv2.imwrite('./out/{}.jpg'.format(counter), cropWords)
-                counter += 1
-        return(counter)
-
-# fonction segmentation des lignes #
-    def linesSegmentation(self):
-        imgCopy = self.original_img.copy()
+                erosion = None
+                if self.erosion is not None:
+                    erosion = self.erosion[top : top + heightCropImg, words[i] : words[i+1]] # morceau de la page érodée
+                cropWords, box = self.resizeWord(cropImg, erosion)
+                if cropWords is None:
+                    continue
+                x, y, width, height = box
+                wordList.append(Word(cropWords, lineIndex, len(wordList), (int(words[i]) + x, int(top) + y, width, height)))
+        tracing.count("segmentation.words", len(wordList))
+        return(wordList)
+
+# fonction segmentation des lignes, une ligne à la fois #
+    def iterLines(self):
+        # génère la liste des mots de chaque ligne dans l'ordre de lecture, une ligne est découpée seulement quand elle est demandée
         heightMax, widthMax = self.original_img.shape[:2]
-        imgBinary, imgGrayscaled = p.binarize(self, self.original_img) # binarisation
+        with tracing.span("segmentation.lines", shape = [heightMax, widthMax]) as span:
+            imgBinary, imgGrayscaled = self.preprocessing.binarize(self.original_img) # binarisation
 
-        # creer liste de la hauteur de l'image
-        heightList = np.arange(heightMax)
+            # une seule binarisation et une seule érosion pour toute la page
+            if self.sharedBinarization:
+                self.binary = imgBinary
+                self.erosion = cv2.erode(imgBinary, None, iterations = 6)
 
-        # creer histogramme horizontal
-        histogram = self.horizontalHistogram(imgBinary)
+            # creer liste de la hauteur de l'image
+            heightList = np.arange(heightMax)
 
-        # lissage de l'histogramme
-        histogramSmoothing = self.smoothing(histogram)
-        moyenneHistogram = np.mean(histogramSmoothing)
+            # creer histogramme horizontal
+            histogram = self.horizontalHistogram(imgBinary)
 
-        # coordonnées de l'espace entre chaque ligne
-        lines = self.lowerPeak(histogramSmoothing, heightList, widthMax, moyenneHistogram)
+            # lissage de l'histogramme
+            histogramSmoothing = self.smoothing(histogram)
+            moyenneHistogram = np.mean(histogramSmoothing)
 
-        # creer dossier "./out"
-        while True:
-            try:
-                os.mkdir("./out")
-                break
-            except:
-                shutil.rmtree("./out")
-
-        # compteur pour le nom des images
-        counter = 1
+            # coordonnées de l'espace entre chaque ligne
+            lines = self.lowerPeak(histogramSmoothing, heightList, widthMax, moyenneHistogram)
+            span.set(gaps = len(lines))
 
         # parcourir les coordonnées de chaque ligne pour les extraires
+        lineIndex = 0
         for i in range(len(lines)-1):
             cropImg = imgGrayscaled[lines[i] : lines[i+1], 0 : widthMax] # extraction des lignes sur l'image en teinte de gris
             heightCropImg, widthCropImg = cropImg.shape[:2]
             if heightCropImg >= 40:
-                test = p.resize(self, cropImg)
-                # cv2.imshow('line segmentation', test)
-                # cv2.waitKey(0)
-                # cv2.destroyAllWindows()
-                counter = self.wordSegmentation(cropImg, counter)
+                self.sink.save('line', cropImg)
+                tracing.count("segmentation.lines")
+                words = self.wordSegmentation(cropImg, lineIndex, lines[i])
+
+                # images des mots pour le débogage
+                for word in words:
+                    self.sink.save('word', word.img)
+
+                yield(words)
+                lineIndex += 1
+
+# fonction segmentation des lignes #
+    def linesSegmentation(self):
+        # retourne la liste des mots de la page dans l'ordre de lecture
+        wordList = []
+        for words in self.iterLines():
+            wordList += words
+        return(wordList)
 
 if __name__ == "__main__":
     ap = argparse.ArgumentParser()
     ap.add_argument("-i", "--image", required=True, help="path to input image file")
+    ap.add_argument("-o", "--out", default=None, help="folder where the line, word and binarized images are saved")
     args = vars(ap.parse_args())
 
     start = time.time()
-    segmentation = TextSegmentation(args["image"])
-    segmentation.linesSegmentation()
+    segmentation = TextSegmentation(cv2.imread(args["image"]), DirectorySink(args["out"]) if args["out"] else None)
+    words = segmentation.linesSegmentation()
     end = time.time()
+    print(len(words), 'words')
     print(end - start) # calcul le temps que le programme met à s'éxecuter
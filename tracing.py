@@ -0,0 +1,194 @@
+import functools
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+
+# nothing is recorded unless enabled, the hooks then cost a global lookup and a call
+enabled = False
+lock = threading.Lock()
+stages = {} # summary of the finished spans of each stage: count, total and max duration (ms)
+counters = defaultdict(int)
+origin = time.perf_counter() # perf_counter is the same clock in all processes of a machine
+output = None # trace file the spans are written to as they end
+chromeFormat = False # whether output is a Chrome trace instead of JSON lines
+firstEvent = True # whether nothing was written to the Chrome trace yet
+collected = None # spans kept for collect(), in worker processes: (name, start, duration, pid, thread, args)
+
+
+def enable(fn=None, collect=False):
+    "start recording spans and counters, forgetting what was recorded before: spans are written to fn as they end (JSON lines if it ends with .jsonl, a Chrome trace otherwise), kept for collect() if collect, else only summarized"
+    global enabled, output, chromeFormat, firstEvent, collected
+    reset()
+    with lock:
+        # line buffered and flushed: a worker process forked later inherits the file with nothing left to flush in its copy
+        output = open(fn, 'w', buffering=1) if fn else None
+        chromeFormat = fn is not None and not fn.endswith('.jsonl')
+        firstEvent = True
+        if chromeFormat:
+            output.write('[')
+            output.flush()
+        collected = [] if collect else None
+        enabled = True
+
+
+def disable():
+    "stop recording, the counters are written to the trace file and it is closed"
+    global enabled, output
+    with lock:
+        enabled = False
+        if output is None:
+            return
+        end = time.perf_counter()
+        for (name, value) in sorted(counters.items()):
+            if chromeFormat:
+                writeEvent({'name': name, 'ph': 'C', 'ts': (end - origin) * 1e6, 'pid': os.getpid(), 'args': {'value': value}})
+            else:
+                writeEvent({'counter': name, 'value': value})
+        if chromeFormat:
+            output.write('\n]\n')
+        output.close()
+        output = None
+
+
+def reset():
+    "forget what was recorded"
+    global origin, collected
+    with lock:
+        stages.clear()
+        counters.clear()
+        if collected is not None:
+            collected = []
+        origin = time.perf_counter()
+
+
+def writeEvent(event):
+    "write an event to the trace file, the lock is held"
+    global firstEvent
+    if chromeFormat:
+        output.write(('\n' if firstEvent else ',\n') + json.dumps(event))
+        firstEvent = False
+    else:
+        output.write(json.dumps(event) + '\n')
+
+
+def record(name, start, duration, pid, thread, args):
+    "add a finished span to the summary and write or keep it"
+    with lock:
+        stage = stages.setdefault(name, {'count': 0, 'totalMs': 0.0, 'maxMs': 0.0})
+        stage['count'] += 1
+        stage['totalMs'] += duration * 1000
+        stage['maxMs'] = max(stage['maxMs'], duration * 1000)
+        if output is not None:
+            if chromeFormat:
+                writeEvent({'name': name, 'ph': 'X', 'ts': (start - origin) * 1e6, 'dur': duration * 1e6, 'pid': pid, 'tid': thread, 'args': args})
+            else:
+                writeEvent({'name': name, 'startMs': (start - origin) * 1000, 'durationMs': duration * 1000, 'pid': pid, 'thread': thread, 'args': args})
+        if collected is not None:
+            collected.append((name, start, duration, pid, thread, args))
+
+
+def collect():
+    "spans and counters recorded since the last call, to be merged by another process, they are forgotten here"
+    global collected
+    with lock:
+        result = (collected or [], dict(counters))
+        if collected is not None:
+            collected = []
+        counters.clear()
+    return result
+
+
+def merge(spansAndCounters):
+    "add the spans and counters returned by collect() in another process"
+    (spans, processCounters) = spansAndCounters
+    if not enabled:
+        return
+    for span in spans:
+        record(*span)
+    with lock:
+        for (name, value) in processCounters.items():
+            counters[name] += value
+
+
+class NullSpan:
+    "span used when tracing is disabled, does nothing"
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **args):
+        pass
+
+nullSpan = NullSpan()
+
+
+class Span:
+    "timed stage, recorded when it ends with its args (sizes, counts, settings)"
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        duration = time.perf_counter() - self.start
+        record(self.name, self.start, duration, os.getpid(), threading.get_ident(), self.args)
+        return False
+
+    def set(self, **args):
+        "add args known only inside the span"
+        self.args.update(args)
+
+
+def span(name, **args):
+    "context manager timing the stage name, args are recorded with it"
+    if not enabled:
+        return nullSpan
+    return Span(name, args)
+
+
+def count(name, value=1):
+    "add value to the counter name"
+    if enabled:
+        with lock:
+            counters[name] += value
+
+
+def traced(name):
+    "decorator timing each call as a span, with the shape of the first array argument"
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            shape = next((list(arg.shape) for arg in args if isinstance(arg, np.ndarray)), None)
+            with Span(name, {'shape': shape} if shape is not None else {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def summary():
+    "count, total, mean and max duration (ms) of each stage, and the counters"
+    with lock:
+        result = {'stages': {name: dict(stage) for (name, stage) in stages.items()}, 'counters': dict(counters)}
+    for stage in result['stages'].values():
+        stage['meanMs'] = stage['totalMs'] / stage['count']
+    return result
+
+
+def formatSummary():
+    "summary as lines of text, slowest stages first"
+    s = summary()
+    lines = ['%s: %d calls, %.1f ms total, %.2f ms mean, %.2f ms max' % (name, stage['count'], stage['totalMs'], stage['meanMs'], stage['maxMs'])
+             for (name, stage) in sorted(s['stages'].items(), key=lambda item: -item[1]['totalMs'])]
+    lines += ['%s: %d' % (name, value) for (name, value) in sorted(s['counters'].items())]
+    return '\n'.join(lines)
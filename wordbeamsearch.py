@@ -0,0 +1,204 @@
+import argparse
+import hashlib
+import os
+import re
+import time
+from collections import Counter
+
+import numpy as np
+
+
+class PrefixTree:
+    "words of a corpus as a prefix tree over model labels, with the number of occurrences of each word and of each prefix"
+
+    def __init__(self, childStart, childLabel, childNode, wordCount, prefixCount):
+        # children of node n are childNode[childStart[n]:childStart[n + 1]], reached with the labels childLabel[...]
+        self.childStart = childStart
+        self.childLabel = childLabel
+        self.childNode = childNode
+        self.wordCount = wordCount # occurrences of the word ending at each node, 0 if no word ends there
+        self.prefixCount = prefixCount # occurrences of the words starting with the prefix of each node
+        self.children = {} # label -> child dicts of the nodes used so far
+
+
+    @staticmethod
+    def build(words, charIds):
+        "tree of the words, counted as often as they occur, words with a char the model doesn't know are left out"
+        counts = Counter(word for word in words if all(c in charIds for c in word))
+        nodes = [{}] # label -> child index of each node
+        wordCount = [0]
+        for (word, count) in counts.items():
+            node = 0
+            for c in word:
+                label = charIds[c]
+                if label not in nodes[node]:
+                    nodes[node][label] = len(nodes)
+                    nodes.append({})
+                    wordCount.append(0)
+                node = nodes[node][label]
+            wordCount[node] += count
+
+        # children are numbered after their parent, so prefix counts add up from the last node to the root
+        prefixCount = list(wordCount)
+        for node in range(len(nodes) - 1, -1, -1):
+            prefixCount[node] += sum(prefixCount[child] for child in nodes[node].values())
+
+        childStart = np.zeros(len(nodes) + 1, dtype=np.int32)
+        childStart[1:] = np.cumsum([len(children) for children in nodes])
+        edges = [(label, child) for children in nodes for (label, child) in sorted(children.items())]
+        childLabel = np.array([label for (label, _) in edges], dtype=np.int32)
+        childNode = np.array([child for (_, child) in edges], dtype=np.int32)
+        return PrefixTree(childStart, childLabel, childNode, np.array(wordCount, dtype=np.int32), np.array(prefixCount, dtype=np.int32))
+
+
+    def child(self, node, label):
+        "node reached from node with label, None if no word continues that way"
+        children = self.children.get(node)
+        if children is None:
+            (start, end) = self.childStart[node], self.childStart[node + 1]
+            children = dict(zip(self.childLabel[start:end].tolist(), self.childNode[start:end].tolist()))
+            self.children[node] = children
+        return children.get(label)
+
+
+    def isWord(self, node):
+        return self.wordCount[node] > 0
+
+
+class WordBeamSearch:
+    "CTC beam search decoding constrained to the words of a corpus, chars that don't form words (digits, punctuation) are free"
+
+    def __init__(self, tree, charList, wordChars, beamWidth=50, lmWeight=0.0, minCharProb=1e-3):
+        # beamWidth -- number of texts kept at each time step
+        # lmWeight -- weight of the word frequencies of the corpus, 0 only constrains the texts to corpus words
+        # minCharProb -- chars less likely than this at a time step aren't tried, smaller is slower and closer to the exact search
+        self.tree = tree
+        self.charList = charList
+        self.wordChars = wordChars
+        self.beamWidth = beamWidth
+        self.lmWeight = lmWeight
+        self.minCharProb = minCharProb
+        self.nonWordLabels = frozenset(i for (i, c) in enumerate(charList) if c not in wordChars)
+
+
+    @staticmethod
+    def corpusWords(corpus, wordChars):
+        "maximal runs of word chars in the corpus"
+        return re.findall('[' + re.escape(wordChars) + ']+', corpus)
+
+
+    @staticmethod
+    def buildIndex(fnCorpus, fnCharList, fnWordCharList, fnIndex):
+        "build the prefix tree of the corpus words and save it to fnIndex with what it was built from"
+        charList = open(fnCharList).read()
+        wordChars = open(fnWordCharList).read().splitlines()[0]
+        charIds = {char: i for (i, char) in reversed(list(enumerate(charList)))}
+        tree = PrefixTree.build(WordBeamSearch.corpusWords(open(fnCorpus).read(), wordChars), charIds)
+        np.savez_compressed(fnIndex, childStart=tree.childStart, childLabel=tree.childLabel, childNode=tree.childNode,
+                            wordCount=tree.wordCount, prefixCount=tree.prefixCount, charList=np.array(charList),
+                            wordChars=np.array(wordChars), corpusStamp=np.array(WordBeamSearch.fileStamp(fnCorpus)))
+        return tree
+
+
+    @staticmethod
+    def fileStamp(fn):
+        "hash of the content of a file, to notice that it changed, hashing is much faster than building the tree"
+        with open(fn, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+
+    @staticmethod
+    def load(fnIndex, fnCorpus, fnCharList, fnWordCharList, **options):
+        "decoder using the saved prefix tree, (re)built from the corpus first if missing or made from other files"
+        charList = open(fnCharList).read()
+        wordChars = open(fnWordCharList).read().splitlines()[0]
+        tree = None
+        if os.path.exists(fnIndex):
+            with np.load(fnIndex) as index:
+                if str(index['charList']) == charList and str(index['wordChars']) == wordChars and str(index['corpusStamp']) == WordBeamSearch.fileStamp(fnCorpus):
+                    tree = PrefixTree(index['childStart'], index['childLabel'], index['childNode'], index['wordCount'], index['prefixCount'])
+        if tree is None:
+            tree = WordBeamSearch.buildIndex(fnCorpus, fnCharList, fnWordCharList, fnIndex)
+        return WordBeamSearch(tree, charList, wordChars, **options)
+
+
+    def settings(self):
+        "description of what changes the decoded texts"
+        return 'beamWidth=%d;lmWeight=%g;minCharProb=%g' % (self.beamWidth, self.lmWeight, self.minCharProb)
+
+
+    def wordFactor(self, node):
+        "language model factor of completing the word of node"
+        if self.lmWeight == 0:
+            return 1.0
+        return (self.tree.wordCount[node] / self.tree.prefixCount[node]) ** self.lmWeight
+
+
+    def decode(self, mat, seqLen=None):
+        "texts of a batch of char probabilities (TxBxC, the softmax of the RNN output, blank last)"
+        (maxT, numBatchElements, _) = mat.shape
+        if seqLen is None:
+            seqLen = [maxT] * numBatchElements
+        return [self.decodeElement(mat[:seqLen[b], b, :]) for b in range(numBatchElements)]
+
+
+    def decodeElement(self, mat):
+        "text of the char probabilities (TxC) of one batch element"
+        tree = self.tree
+        blank = mat.shape[1] - 1
+        root = 0
+        total = float(tree.prefixCount[root])
+
+        # beams by labeling: [prBlank, prNonBlank, prText, node], node is the prefix tree node of the last word or -1 after a non-word char
+        beams = {(): [1.0, 0.0, 1.0, -1]}
+        for t in range(mat.shape[0]):
+            probs = mat[t]
+            candidates = np.flatnonzero(probs[:blank] >= self.minCharProb).tolist()
+            best = sorted(beams.items(), key=lambda item: (item[1][0] + item[1][1]) * item[1][2], reverse=True)[:self.beamWidth]
+            beams = {}
+            for (labeling, (prBlank, prNonBlank, prText, node)) in best:
+                prTotal = prBlank + prNonBlank
+
+                # same labeling: last label repeated, or a blank
+                entry = beams.setdefault(labeling, [0.0, 0.0, prText, node])
+                if labeling:
+                    entry[1] += prNonBlank * probs[labeling[-1]]
+                entry[0] += prTotal * probs[blank]
+
+                # labeling extended by a label, inside a word only with labels continuing it, between words with any
+                for label in candidates:
+                    if label in self.nonWordLabels:
+                        if node >= 0 and not tree.isWord(node):
+                            continue
+                        (newNode, newText) = (-1, prText * self.wordFactor(node) if node >= 0 else prText)
+                    else:
+                        newNode = tree.child(node if node >= 0 else root, label)
+                        if newNode is None:
+                            continue
+                        parentCount = tree.prefixCount[node] if node >= 0 else total
+                        newText = prText * (tree.prefixCount[newNode] / parentCount) ** self.lmWeight if self.lmWeight else prText
+                    newLabeling = labeling + (label,)
+                    pr = probs[label] * (prBlank if labeling and labeling[-1] == label else prTotal)
+                    entry = beams.setdefault(newLabeling, [0.0, 0.0, newText, newNode])
+                    entry[1] += pr
+
+        # the last word must be complete, unless no beam has one
+        def score(item):
+            (prBlank, prNonBlank, prText, node) = item[1]
+            return (prBlank + prNonBlank) * (prText * self.wordFactor(node) if node >= 0 else prText)
+        complete = [item for item in beams.items() if item[1][3] < 0 or tree.isWord(item[1][3])]
+        (labeling, _) = max(complete or beams.items(), key=score)
+        return str().join(self.charList[label] for label in labeling)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--corpus", default="./Classification/data/corpus.txt", help="text the words are taken from")
+    ap.add_argument("--chars", default="./Classification/model/charList.txt", help="chars of the model, in label order")
+    ap.add_argument("--word-chars", default="./Classification/model/wordCharList.txt", help="chars forming words")
+    ap.add_argument("-o", "--out", default="./Classification/model/corpusIndex.npz", help="file the prefix tree is saved to")
+    args = vars(ap.parse_args())
+
+    start = time.time()
+    tree = WordBeamSearch.buildIndex(args["corpus"], args["chars"], args["word_chars"], args["out"])
+    print('%d words, %d nodes written to %s in %.2f s' % ((tree.wordCount > 0).sum(), len(tree.wordCount), args["out"], time.time() - start))